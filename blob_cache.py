@@ -0,0 +1,266 @@
+"""Content-addressed on-disk cache for CDN download blobs.
+
+Blobs under /download/<hash> never change, so anything fetched once can be
+served from disk on later runs. Each hash gets a directory holding the byte
+ranges fetched so far; a request is a hit if the whole blob is present or
+stored ranges cover it end to end, so a range can be served from pieces
+fetched by requests that split the blob differently."""
+
+import os
+import mmap
+import errno
+import atexit
+import shutil
+import tempfile
+import threading
+
+CURDIR = os.path.dirname(__file__)
+TEMPDIR = os.path.join(CURDIR, '.temp_models')
+BLOB_DIR = os.path.join(TEMPDIR, 'blobs')
+
+MAX_CACHE_BYTES = 4 * 1024 * 1024 * 1024 # 4 GB
+"""Size cap for the cache, least recently used blobs are evicted past this"""
+EVICT_TO_FRACTION = 0.9
+"""Eviction removes blobs until the cache is below this fraction of the cap"""
+
+FULL_BLOB = 'full'
+
+def _entry_name(httprange):
+    if httprange is None:
+        return FULL_BLOB
+    offset, length = httprange
+    return '%d-%d' % (offset, length)
+
+def _parse_entry_name(name):
+    """Returns the (offset, length) range for an entry name, None for a full
+    blob, or False if the name isn't a cache entry"""
+    if name == FULL_BLOB:
+        return None
+    try:
+        offset, length = name.split('-')
+        return int(offset), int(length)
+    except ValueError:
+        return False
+
+def _read_mmap(path, start, length):
+    """Reads length bytes at start from path through mmap. Returns None if
+    the file is missing or too short."""
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if length is None:
+            length = size - start
+        if start + length > size:
+            return None
+        if length == 0:
+            return ''
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return m[start:start + length]
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+class BlobCache(object):
+    """A size-capped LRU cache of blobs keyed by hash and byte range"""
+
+    def __init__(self, directory=BLOB_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._size = None
+
+    def _hash_dir(self, dlhash):
+        return os.path.join(self.directory, dlhash[:2], dlhash)
+
+    def _find(self, dlhash, httprange):
+        """Returns a list of (path, start, length) pieces of stored entries
+        that together cover httprange, in order, or None"""
+        hash_dir = self._hash_dir(dlhash)
+        try:
+            names = os.listdir(hash_dir)
+        except OSError:
+            return None
+
+        if FULL_BLOB in names:
+            if httprange is None:
+                return [(os.path.join(hash_dir, FULL_BLOB), 0, None)]
+            offset, length = httprange
+            return [(os.path.join(hash_dir, FULL_BLOB), offset, length)]
+
+        if httprange is None:
+            return None
+
+        stored_ranges = []
+        for name in names:
+            stored = _parse_entry_name(name)
+            if not stored:
+                continue
+            stored_offset, stored_length = stored
+            path = os.path.join(hash_dir, name)
+            try:
+                if os.path.getsize(path) < stored_length:
+                    # written under the range it was requested for by an
+                    # older version, so it doesn't hold what its name says
+                    continue
+            except OSError:
+                continue
+            stored_ranges.append((stored_offset, stored_offset + stored_length, path))
+
+        # from the start of the range, take whichever entry holding the
+        # next byte reaches furthest, until the end is reached
+        offset, length = httprange
+        end = offset + length
+        pieces = []
+        pos = offset
+        while pos < end:
+            holding = [(stored_end, stored_offset, path) for stored_offset, stored_end, path in stored_ranges
+                       if stored_offset <= pos < stored_end]
+            if len(holding) == 0:
+                return None
+            stored_end, stored_offset, path = max(holding)
+            piece_end = min(end, stored_end)
+            pieces.append((path, pos - stored_offset, piece_end - pos))
+            pos = piece_end
+        return pieces
+
+    def get(self, dlhash, httprange=None):
+        """Returns the cached data for hash and range, or None if missing"""
+        if self.max_bytes <= 0:
+            return None
+
+        pieces = self._find(dlhash, httprange)
+        if pieces is None:
+            return None
+
+        datas = []
+        for path, start, length in pieces:
+            data = _read_mmap(path, start, length)
+            if data is None:
+                return None
+            datas.append(data)
+            # mtime doubles as the last access time for LRU eviction
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        if len(datas) == 1:
+            return datas[0]
+        return ''.join(datas)
+
+    def put(self, dlhash, httprange, data):
+        """Stores data for hash and range. The entry is named after the
+        bytes actually received, which is less than the range asked for when
+        it runs past the end of the blob. The write is atomic, so readers
+        in other processes never see a partial file."""
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        if httprange is not None:
+            httprange = (httprange[0], len(data))
+
+        hash_dir = self._hash_dir(dlhash)
+        try:
+            os.makedirs(hash_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=hash_dir, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmp_path, os.path.join(hash_dir, _entry_name(httprange)))
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        if httprange is None:
+            # the full blob covers every partial range stored so far
+            for name in os.listdir(hash_dir):
+                if _parse_entry_name(name):
+                    try:
+                        os.remove(os.path.join(hash_dir, name))
+                    except OSError:
+                        pass
+
+        with self.lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            else:
+                self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self):
+        """Returns (mtime, size, path) for every entry in the cache"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if _parse_entry_name(name) is False:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _disk_usage(self):
+        return sum(size for mtime, size, path in self._entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache is back
+        under its size cap"""
+        with self.lock:
+            entries = sorted(self._entries())
+            total = sum(size for mtime, size, path in entries)
+            target = self.max_bytes * EVICT_TO_FRACTION
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            self._size = total
+
+_CACHE = None
+
+def get_cache():
+    """Returns the blob cache shared by this process"""
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = BlobCache()
+    return _CACHE
+
+def use_session_cache():
+    """Replaces the shared cache with an empty one in a new directory that
+    is removed when the process exits, so nothing cached by earlier runs is
+    read and the persistent cache is left alone. Downloads are still shared
+    within this run. Call before any pool workers are started."""
+    global _CACHE
+    try:
+        os.makedirs(TEMPDIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    directory = tempfile.mkdtemp(prefix='session-blobs-', dir=TEMPDIR)
+    atexit.register(shutil.rmtree, directory, True)
+    _CACHE = BlobCache(directory, MAX_CACHE_BYTES)
+
+def set_max_bytes(max_bytes):
+    """Sets the cache size cap. A cap of 0 disables the cache."""
+    global MAX_CACHE_BYTES
+    MAX_CACHE_BYTES = max_bytes
+    get_cache().max_bytes = max_bytes
@@ -0,0 +1,168 @@
+"""Runtime control of how many tasks a TaskPool runs at once.
+
+A TaskPool with a controller reports every task it finishes to it, and asks
+it for a new concurrency limit each time it polls. Controllers look at what
+finished over a window of CONTROL_INTERVAL seconds and move the limit
+between their minimum and maximum."""
+
+import os
+import time
+import multiprocessing
+
+CONTROL_INTERVAL = 2.0
+"""Seconds of task completions a controller looks at before adjusting"""
+THROUGHPUT_SMOOTHING = 0.3
+"""Weight of the newest window in the download throughput estimate"""
+AIMD_DECREASE_FACTOR = 0.75
+"""Download concurrency is multiplied by this when the network is saturated"""
+AIMD_MIN_GAIN = 1.1
+"""Throughput has to grow by this factor over the previous window for more
+concurrency to count as helping"""
+AIMD_LATENCY_TOLERANCE = 2.0
+"""Task latency above this multiple of the best seen counts as queueing"""
+CPU_SATURATION = 1.0
+"""Load average per CPU above which the load concurrency is lowered"""
+
+class ThroughputEstimator(object):
+    """Smoothed estimate of the bytes per second downloads are getting"""
+
+    def __init__(self, smoothing=THROUGHPUT_SMOOTHING):
+        self.smoothing = smoothing
+        self.bytes_per_second = None
+
+    def add_sample(self, bytes_per_second):
+        if self.bytes_per_second is None:
+            self.bytes_per_second = bytes_per_second
+        else:
+            self.bytes_per_second += self.smoothing * (bytes_per_second - self.bytes_per_second)
+
+THROUGHPUT = ThroughputEstimator()
+"""Download throughput of this process, fed by the AIMDController"""
+
+def get_throughput(default=None):
+    """Returns the estimated download throughput in bytes per second, or
+    default before any download has finished"""
+    if THROUGHPUT.bytes_per_second is None:
+        return default
+    return THROUGHPUT.bytes_per_second
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class ConcurrencyController(object):
+    """Base class for concurrency controllers. Subclasses implement adjust()
+    to pick a new limit from the stats of the last window."""
+
+    def __init__(self, initial, min_limit, max_limit):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = self.clamp(initial)
+        self._reset_window(time.time())
+
+    def clamp(self, limit):
+        return max(self.min_limit, min(self.max_limit, int(limit)))
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.window_tasks = 0
+        self.window_bytes = 0
+        self.window_seconds = 0.0
+
+    def task_finished(self, task, seconds, num_bytes):
+        """Records a task that finished after running for seconds, having
+        downloaded num_bytes"""
+        self.window_tasks += 1
+        self.window_bytes += num_bytes
+        self.window_seconds += seconds
+
+    def update(self, pool):
+        """Returns the concurrency limit pool should use now"""
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed >= CONTROL_INTERVAL and self.window_tasks > 0:
+            self.limit = self.clamp(self.adjust(pool, elapsed))
+            self._reset_window(now)
+        return self.limit
+
+    def adjust(self, pool, elapsed):
+        raise NotImplementedError()
+
+    def describe(self):
+        """Returns a short description of the controller's state for logging"""
+        return 'limit %d' % self.limit
+
+class AIMDController(ConcurrencyController):
+    """Additive increase, multiplicative decrease control for downloads.
+
+    While tasks are queued the limit grows by one each window. When tasks
+    take much longer than the best seen without throughput growing, requests
+    are just queueing on a saturated connection and the limit is cut."""
+
+    def __init__(self, initial, min_limit, max_limit, estimator=THROUGHPUT):
+        super(AIMDController, self).__init__(initial, min_limit, max_limit)
+        self.estimator = estimator
+        self.last_throughput = None
+        self.best_latency = None
+
+    def adjust(self, pool, elapsed):
+        throughput = self.window_bytes / elapsed
+        latency = self.window_seconds / self.window_tasks
+
+        # windows served entirely from the blob cache say nothing about the network
+        if self.window_bytes > 0:
+            self.estimator.add_sample(throughput)
+
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+
+        stalled = self.last_throughput is not None and throughput < self.last_throughput * AIMD_MIN_GAIN
+        queueing = latency > self.best_latency * AIMD_LATENCY_TOLERANCE
+        self.last_throughput = throughput
+
+        if stalled and queueing:
+            # the best latency was measured at a lower load, let it drift up
+            # so one lucky window doesn't pin the limit down forever
+            self.best_latency = (self.best_latency + latency) / 2.0
+            return min(self.limit - 1, self.limit * AIMD_DECREASE_FACTOR)
+        if len(pool.to_run) > 0:
+            return self.limit + 1
+        return self.limit
+
+    def describe(self):
+        throughput = self.estimator.bytes_per_second
+        if throughput is None:
+            return 'limit %d' % self.limit
+        return 'limit %d, %.1f KB/s' % (self.limit, throughput / 1024.0)
+
+class LoadController(ConcurrencyController):
+    """Controls CPU bound loading by CPU saturation and queue depth.
+
+    The limit grows while tasks are queued and the CPUs have headroom, and
+    shrinks when the CPUs are saturated or the queue has run dry, leaving
+    the cores to the renderer."""
+
+    def __init__(self, initial, min_limit, max_limit):
+        super(LoadController, self).__init__(initial, min_limit, max_limit)
+        self.cpu_load = None
+
+    def adjust(self, pool, elapsed):
+        try:
+            self.cpu_load = os.getloadavg()[0] / cpu_count()
+        except (AttributeError, OSError):
+            self.cpu_load = None
+
+        if self.cpu_load is not None and self.cpu_load > CPU_SATURATION:
+            return self.limit - 1
+        if len(pool.to_run) > self.limit:
+            return self.limit + 1
+        if len(pool.to_run) == 0 and len(pool.running) < self.limit:
+            return self.limit - 1
+        return self.limit
+
+    def describe(self):
+        if self.cpu_load is None:
+            return 'limit %d' % self.limit
+        return 'limit %d, cpu load %.2f' % (self.limit, self.cpu_load)
@@ -1,21 +1,27 @@
 import os
 import sys
+import atexit
 import thread
 import threading
 import time
 import Queue
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
 import multiprocessing
 import pickle
 import random
+import traceback
+import itertools
+import collections
 import shutil
 import math
 
+import numpy
+
 from direct.showbase.ShowBase import ShowBase
 from direct.gui.OnscreenText import OnscreenText
 from panda3d.core import TransparencyAttrib, AntialiasAttrib, TextureAttrib, TextureStage
 from panda3d.core import VBase4, Vec3
-from panda3d.core import PNMImage, Texture, StringStream, GeomNode
+from panda3d.core import GeomNode
 from panda3d.core import loadPrcFileData
 
 import argparse
@@ -26,6 +32,13 @@ from meshtool.filters.panda_filters.pdae_utils import PM_OP
 
 import scene
 import load_scheduler
+import concurrency
+import tracing
+import priority_policy
+import prefetch
+import open3dhub
+import blob_cache
+import fetcher
 from p3d_mesh_updater import update_nodepath
 
 loadPrcFileData('', 'win-size 1024 768')
@@ -42,8 +55,10 @@ TEMPDIR = os.path.join(CURDIR, '.temp_models')
 
 FORCE_MODEL_DOWNLOAD = None
 SAVE_SS = None
-NUM_DOWNLOAD_PROCS = 4 #multiprocessing.cpu_count() * 2
-NUM_LOAD_PROCS = 2 #multiprocessing.cpu_count()
+NUM_DOWNLOAD_PROCS = 4
+MAX_DOWNLOAD_PROCS = 32
+NUM_LOAD_PROCS = 2
+MAX_LOAD_PROCS = multiprocessing.cpu_count()
 START_TIME = 0
 LAST_SCREENSHOT = 0
 NUM_MODELS = None
@@ -52,13 +67,12 @@ MODEL_SUBTYPE = None
 MODEL_TYPE = None
 HASH_SIZES = None
 
-PANDA3D = False
-
 class MyBase(ShowBase):
     def __init__(self):
         ShowBase.__init__(self)
         
         self.num_models_loaded = 0
+        self.num_models_failed = 0
         self.quit = False
         self.quit_frame = sys.maxint
         self.screenshot_frame = sys.maxint
@@ -67,38 +81,109 @@ class MyBase(ShowBase):
     def userExit(self):
         sys.exit(0)
 
-MAX_SOLID_ANGLE = 4.0 * math.pi
-def solid_angle(cameraLoc, objLoc, objRadius):
-    """Calculates the solid angle between the camera and an object"""
-    
-    to_center = cameraLoc - objLoc
-    
-    to_center_len = to_center.length()
-    if to_center_len <= objRadius:
-        return MAX_SOLID_ANGLE
-    
-    sin_alpha = objRadius / to_center_len
-    cos_alpha = math.sqrt(1.0 - sin_alpha * sin_alpha)
-    return 2.0 * math.pi * (1.0 - cos_alpha)
-
 class LoadingThread(threading.Thread):
     
-    def __init__(self, model_list):
+    def __init__(self, model_list, camera_pos, camera_heading=None, fov=None):
         super(LoadingThread, self).__init__()
         self.model_list = model_list
+        self.camera_pos = camera_pos
+        self.camera_heading = camera_heading
+        self.posted_camera_pos = camera_pos
+        self.posted_camera_heading = camera_heading
+        self.posted_camera_time = time.time()
+        self.posted_camera_moving = False
+        # both pools wake this thread up through this condition, and so
+        # does update_camera
+        self.wakeup = threading.Condition()
+        self.new_camera = None
+        self.parked_textures = load_scheduler.ParkedTextures()
+        
+        self.model_locs, self.model_radii = scene.model_bounds(model_list)
+        # without a view frustum, models are scored by solid angle alone
+        self.half_fov = None
+        if fov is not None:
+            self.half_fov = prefetch.half_fov_radians(fov)
+        self.predictor = prefetch.CameraPredictor()
+    
+    def update_camera(self, camera_pos, camera_heading=None):
+        """Called from the render thread when the camera has moved or
+        turned, so that waiting tasks get reprioritized for the new view"""
+        now = time.time()
+        self.posted_camera_moving = camera_pos != self.posted_camera_pos or camera_heading != self.posted_camera_heading
+        self.posted_camera_pos = camera_pos
+        self.posted_camera_heading = camera_heading
+        self.posted_camera_time = now
+        with self.wakeup:
+            self.new_camera = (camera_pos, camera_heading, now)
+            self.wakeup.notify_all()
+    
+    def _woken(self):
+        return self.new_camera is not None
+    
+    def _score_models(self, when=None):
+        """Sets each model's solid angle from the camera, weighted by whether
+        the model is in view, about to come into view, or neither"""
+        angles = scene.solid_angles(numpy.array(self.camera_pos), self.model_locs, self.model_radii)
+        for model, angle in zip(self.model_list, angles):
+            model.screen_solid_angle = float(angle)
+        if self.camera_heading is not None and self.half_fov is not None:
+            self.predictor.update(self.camera_pos, self.camera_heading, when)
+            angles = angles * prefetch.view_weights(self.predictor, self.half_fov, self.model_locs, self.model_radii)
+        for model, angle in zip(self.model_list, angles):
+            model.solid_angle = float(angle)
+    
+    def _reprioritize(self, download_pool, loader_pool):
+        with self.wakeup:
+            new_camera = self.new_camera
+            self.new_camera = None
+        if new_camera is None:
+            return
+        
+        self.camera_pos, self.camera_heading, when = new_camera
+        self._score_models(when)
+        # models that grew on screen need the texture levels held back for them
+        resumed = self.parked_textures.resume()
+        if len(resumed) > 0:
+            print 'resuming', len(resumed), 'parked texture tasks'
+        for texture_task in resumed:
+            download_pool.add_task(texture_task)
+        # models that shrank on screen may already be at their target
+        # quality, so their waiting texture levels are held back until they
+        # grow again. Models that left the view keep their tasks at a low
+        # priority, and running ones are preempted and queued again.
+        num_parked = self.parked_textures.park_waiting(download_pool)
+        if num_parked > 0:
+            print 'parked', num_parked, 'texture tasks of models at their target quality'
+        for pool in [download_pool, loader_pool]:
+            pool.reprioritize(load_scheduler.rescale_priority)
     
     def _run(self):
         
-        download_pool = load_scheduler.TaskPool(NUM_DOWNLOAD_PROCS)
-        loader_pool = load_scheduler.TaskPool(NUM_LOAD_PROCS)
+        # pools get as many workers as they may ever use, their controllers
+        # decide how many of them run at a time
+        download_controller = concurrency.AIMDController(NUM_DOWNLOAD_PROCS, 1, MAX_DOWNLOAD_PROCS)
+        # the controller should find the limit of the network, not of the
+        # connection pool
+        fetcher.set_max_transfers(download_controller.max_limit)
+        download_pool = load_scheduler.TaskPool(MAX_DOWNLOAD_PROCS, self.wakeup, preempt=True,
+                                                executor=load_scheduler.ThreadExecutor,
+                                                controller=download_controller, name='download')
+        load_controller = concurrency.LoadController(NUM_LOAD_PROCS, 1, max(NUM_LOAD_PROCS, MAX_LOAD_PROCS))
+        loader_pool = load_scheduler.TaskPool(load_controller.max_limit, self.wakeup,
+                                              controller=load_controller, name='load')
+        # texture decoding gets a thread of its own, so that its CPU time
+        # doesn't count as download latency. One thread keeps the levels of a
+        # texture in order.
+        decode_pool = ThreadPool(1)
+        pending_decodes = []
+        finished_loading = False
         last_status = time.time()
         
+        self._score_models()
         for model in self.model_list:
             model.model_type = MODEL_TYPE
-            model.solid_angle = solid_angle(Vec3(0, 30000, 10000), Vec3(model.x, model.y, model.z), model.scale * 1000)
             model.bam_file = model.model_json['full_path'].replace('/', '_')
             model.model_subtype = MODEL_SUBTYPE
-            model.HASH_SIZES = HASH_SIZES
             extra_part = ''
             if model.model_type == 'progressive':
                 extra_part = '.' + MODEL_SUBTYPE
@@ -108,84 +193,47 @@ class LoadingThread(threading.Thread):
                 load_queue.put((ActionType.LOAD_MODEL, model))
             else:
                 
-                if PANDA3D:
-                    panda3d_key = 'panda3d_%s_bam' % model.model_subtype if model.model_type == 'progressive' else 'panda3d_bam'
-                    panda3d_hash =  model.model_json['metadata']['types'][model.model_type][panda3d_key]
-                    download_size = HASH_SIZES[panda3d_hash]['gzip_size']
-                else:
-                    model_hash =  model.model_json['metadata']['types'][model.model_type]['hash']
-                    subfile_hashes = model.model_json['metadata']['types'][model.model_type]['subfile_hashes']
-                    
-                    download_size = HASH_SIZES[model_hash]['gzip_size']
-                    
-                    if model.model_type == 'progressive':
-                        
-                        if model.model_subtype == 'base':
-                        
-                            for subfile in model.model_json['metadata']['types'][model.model_type]['subfiles']:
-                                splitpath = subfile.split('/')
-                                basename = './' + splitpath[-2]
-                                
-                                mipmaps = model.model_json['metadata']['types'][model.model_type]['mipmaps']
-                                mipmap_levels = mipmaps[basename]['byte_ranges']
-                                offset = 0
-                                length = 0
-                                for mipmap in mipmap_levels:
-                                    offset = mipmap['offset']
-                                    length = mipmap['length']
-                                    if mipmap['width'] >= 128 or mipmap['height'] >= 128:
-                                        break
-    
-                                download_size += length
-                        
-                        elif model.model_subtype == 'full':
-                            
-                            prog_hash = model.model_json['metadata']['types'][model.model_type].get('progressive_stream')
-                            if prog_hash is not None:
-                                download_size += HASH_SIZES[prog_hash]['gzip_size']
-                            
-                            for subfile in model.model_json['metadata']['types'][model.model_type]['subfiles']:
-                                splitpath = subfile.split('/')
-                                basename = './' + splitpath[-2]
-                                
-                                mipmaps = model.model_json['metadata']['types'][model.model_type]['mipmaps']
-                                mipmap_levels = mipmaps[basename]['byte_ranges']
-                                length = 0
-                                for mipmap in mipmap_levels:
-                                    length = mipmap['length']
-                                
-                                download_size += length
-                            
-                        else:
-                            raise Exception("unknown model subtype")
-                        
-                    else:
-                        for subfile_hash in subfile_hashes:
-                            download_size += HASH_SIZES[subfile_hash]['gzip_size']
-                    
-                    
-                # we want to normalize by file size
-                priority = model.solid_angle / float(download_size)
-                # but then also boost by a lot so that progressive download tasks don't overtake
-                priority = priority * 1 * 1000 * 1000 * 1000 * 1000
-                
+                priority = priority_policy.get_policy().model_priority(model)
                 dt = load_scheduler.ModelDownloadTask(model, priority=priority)
                 download_pool.add_task(dt)
         
-        while not(download_pool.empty() and loader_pool.empty()):
+        while not(download_pool.empty() and loader_pool.empty()) or len(self.parked_textures) > 0:
+            if download_pool.empty() and loader_pool.empty():
+                if not finished_loading:
+                    # textures still being decoded are posted before QUIT
+                    for result in pending_decodes:
+                        result.wait()
+                    print 'Finished loading all models'
+                    load_queue.put((ActionType.QUIT, ))
+                    finished_loading = True
+                # only a change of view can bring the parked textures back
+                with self.wakeup:
+                    while not self._woken():
+                        self.wakeup.wait()
+                self._reprioritize(download_pool, loader_pool)
+                continue
+            
             now = time.time()
             if now - last_status > 5.0:
                 last_status = now
-                print 'Downloader has', len(download_pool.running), 'running and', len(download_pool.to_run), 'waiting'
-                print 'Loader has', len(loader_pool.running), 'running and', len(loader_pool.to_run), 'waiting'
+                print 'Downloader has', len(download_pool.running), 'running and', len(download_pool.to_run), 'waiting,', download_pool.describe_concurrency()
+                print 'Loader has', len(loader_pool.running), 'running and', len(loader_pool.to_run), 'waiting,', loader_pool.describe_concurrency()
             
             finished_tasks = download_pool.poll() + loader_pool.poll()
             
+            for failed_task in download_pool.take_failed() + loader_pool.take_failed():
+                # a model that failed to download or load won't be attached,
+                # failed refinements just leave it at the quality it has
+                if isinstance(failed_task, (load_scheduler.ModelDownloadTask, load_scheduler.LoadTask)):
+                    load_queue.put((ActionType.MODEL_FAILED, failed_task.model))
+            
             for finished_task in finished_tasks:
                 print 'finished task', finished_task, 'has', len(finished_task.dependents), 'dependents'
                 
                 for dependent in finished_task.dependents:
-                    if isinstance(dependent, load_scheduler.DownloadTask):
+                    if self.parked_textures.park(dependent):
+                        print 'parking a texture task its model does not need yet'
+                    elif isinstance(dependent, load_scheduler.DownloadTask):
                         print 'adding a dependent download task'
                         download_pool.add_task(dependent)
                     elif isinstance(dependent, load_scheduler.LoadTask):
@@ -198,16 +246,30 @@ class LoadingThread(threading.Thread):
                     print 'posting finished load task'
                     load_queue.put((ActionType.LOAD_MODEL, finished_task.model))
                 elif isinstance(finished_task, load_scheduler.TextureDownloadTask):
-                    load_queue.put((ActionType.UPDATE_TEXTURE, finished_task.model, finished_task.offset, finished_task.data))
+                    pending_decodes = [result for result in pending_decodes if not result.ready()]
+                    pending_decodes.append(decode_pool.apply_async(decodeTexture, (finished_task.model,
+                                                                                   finished_task.texture_name,
+                                                                                   finished_task.offset,
+                                                                                   finished_task.data)))
                 elif isinstance(finished_task, load_scheduler.ProgressiveDownloadTask):
                     load_queue.put((ActionType.PROGRESSIVE_ADDITION, finished_task.model, finished_task.refinements))
                 else:
                     print 'not doing anything for type', type(finished_task)
-                
-            time.sleep(0.05)
             
-        print 'Finished loading all models'
-        load_queue.put((ActionType.QUIT, ))
+            # dependents that were just added get dispatched by the next
+            # poll, otherwise sleep until a running task completes
+            if len(finished_tasks) == 0:
+                load_scheduler.wait_any([download_pool, loader_pool], woken=self._woken)
+            
+            self._reprioritize(download_pool, loader_pool)
+        
+        # textures still being decoded are posted before QUIT
+        decode_pool.close()
+        decode_pool.join()
+        
+        if not finished_loading:
+            print 'Finished loading all models'
+            load_queue.put((ActionType.QUIT, ))
 
     def run(self):
         try:
@@ -215,6 +277,39 @@ class LoadingThread(threading.Thread):
         except (KeyboardInterrupt, SystemExit):
             return
     
+def decodeTexture(model, texture_name, offset, data):
+    """Decodes a downloaded texture level off the render thread and posts
+    it to be swapped in"""
+    try:
+        texture = open3dhub.decode_texture(data, texture_name)
+    except Exception:
+        traceback.print_exc()
+        return
+    load_queue.put((ActionType.UPDATE_TEXTURE, model, texture_name, offset, texture))
+
+CAMERA_MOVE_THRESHOLD = 500.0
+"""Distance the camera has to move before load tasks are reprioritized"""
+CAMERA_TURN_THRESHOLD = 10.0
+"""Degrees the camera has to turn before load tasks are reprioritized"""
+CAMERA_SAMPLE_INTERVAL = 1.0
+"""Seconds after which a camera that moved less than the thresholds is
+posted anyway, so the prefetcher sees slow motion and when it stops"""
+def trackCamera(loading_thread, task):
+    """Hands the camera position and heading to the loading thread whenever
+    it moves or turns"""
+    pos = base.cam.getPos(render)
+    heading = base.cam.getQuat(render).getForward()
+    last_pos = Vec3(*loading_thread.posted_camera_pos)
+    last_heading = Vec3(*loading_thread.posted_camera_heading)
+    
+    moved = (pos - last_pos).length()
+    turned = math.degrees(math.acos(max(-1.0, min(1.0, heading.dot(last_heading)))))
+    if moved > CAMERA_MOVE_THRESHOLD or turned > CAMERA_TURN_THRESHOLD or \
+            (time.time() - loading_thread.posted_camera_time > CAMERA_SAMPLE_INTERVAL and (moved > 0 or turned > 0 or loading_thread.posted_camera_moving)):
+        loading_thread.update_camera((pos.getX(), pos.getY(), pos.getZ()),
+                                     (heading.getX(), heading.getY(), heading.getZ()))
+    return task.cont
+
 def triggerScreenshot(task):
     global LAST_SCREENSHOT
     this_timestamp = (time.clock() - START_TIME)
@@ -224,22 +319,52 @@ def triggerScreenshot(task):
         base.win.saveScreenshot(os.path.join(SAVE_SS, ('%07.2f' % this_timestamp) + '.png'))
     return task.cont
 
-model_queued = False
-model_queue = []
+MAX_CONCURRENT_LOADS = 4
+"""Number of bam files Panda3D's asynchronous loader reads at once"""
+
+class PendingLoads(object):
+    """Models whose bam files are waiting to be read or being read.
+    
+    Up to max_loads are read at once, largest solid angle first. A model
+    that finishes reading is attached by an ATTACH_MODEL action ahead of
+    its other actions, within the frame budget like the rest."""
+    
+    def __init__(self, max_loads=MAX_CONCURRENT_LOADS):
+        self.max_loads = max_loads
+        self.waiting = []
+        self.num_loading = 0
+    
+    def __len__(self):
+        return len(self.waiting) + self.num_loading
+    
+    def add(self, model):
+        self.waiting.append(model)
+        self.start_loads()
+    
+    def start_loads(self):
+        while self.num_loading < self.max_loads and len(self.waiting) > 0:
+            # solid angles change as the camera moves, so pick at the last moment
+            model = max(self.waiting, key=lambda m: m.solid_angle)
+            self.waiting.remove(model)
+            self.num_loading += 1
+            print 'LOADING MODEL', model.bam_file
+            loader.loadModel(model.bam_file, callback=self._loaded, extraArgs=[model])
+    
+    def _loaded(self, np, model):
+        self.num_loading -= 1
+        # the model's updates were held until now, and come after it
+        pending_actions.unblock(model)
+        pending_actions.add_first((ActionType.ATTACH_MODEL, model, np))
+        self.start_loads()
+
+pending_loads = PendingLoads()
 
-def checkQueue():
-    global model_queue
-    global model_queued
-    
-    if not model_queued and len(model_queue) > 0:
-        model_queued = True
-        model = model_queue.pop(0)
-        print 'LOADING MODEL', model.bam_file, modelLoaded
-        loader.loadModel(model.bam_file, callback=modelLoaded, extraArgs=[model])
+ModelNodes = collections.namedtuple('ModelNodes', ['root', 'primitive'])
+"""The NodePaths of an attached model that updates are applied to"""
+model_nodes = {}
+"""ModelNodes of every model in the scene, by model"""
 
 def modelLoaded(np, model):
-    global model_queued
-    
     print 'Model loaded', base.num_models_loaded, model.model_json['full_path']
     np.setPos(model.x, model.y, model.z)
     np.setScale(model.scale, model.scale, model.scale)
@@ -247,9 +372,9 @@ def modelLoaded(np, model):
     zRange = math.fabs(minPt.getZ() - maxPt.getZ())
     np.setPos(model.x, model.y, zRange / 2.0)
     np.reparentTo(render)
+    model_nodes[model] = ModelNodes(np, np.find("**/primitive"))
     base.num_models_loaded += 1
     base.quit_frame = globalClock.getFrameCount()
-    model_queued = False
     #base.txtModelsLoaded.setText('Models Loaded: %d/%d' % (base.num_models_loaded, NUM_MODELS))
 
 class ActionType(object):
@@ -257,60 +382,184 @@ class ActionType(object):
     UPDATE_TEXTURE = 1
     PROGRESSIVE_ADDITION = 2
     QUIT = 3
+    ATTACH_MODEL = 4
+    MODEL_FAILED = 5
+
+FRAME_BUDGET = 0.004
+"""Seconds of each frame spent applying actions from load_queue"""
+ACTION_COST_SMOOTHING = 0.2
+"""Weight of the newest timing in the estimated cost of an action type"""
+
+def action_size(action):
+    """Returns the amount of work in an action, in the units its type's
+    cost is estimated per"""
+    action_type = action[0]
+    if action_type == ActionType.UPDATE_TEXTURE:
+        return action[4].getRamImageSize()
+    if action_type == ActionType.PROGRESSIVE_ADDITION:
+        return len(action[2])
+    return 1
+
+class PendingActions(object):
+    """Actions taken off load_queue that are waiting for frame time.
+    
+    Each model's actions stay in the order they were posted, since
+    refinements have to be applied in stream order, and are held while
+    the model is blocked. Among the first waiting action of each model, the
+    cheapest goes first, estimated from how long actions of its type have
+    taken per unit of action_size, and the model with the largest solid
+    angle among equally cheap ones."""
+    
+    def __init__(self):
+        self.by_model = {}
+        self.blocked = set()
+        self.cost_per_unit = {}
+        self.arrivals = itertools.count()
+    
+    def __len__(self):
+        return len(self.by_model)
+    
+    def add(self, action):
+        # QUIT has no model, and is only applied once nothing else waits
+        key = id(action[1]) if len(action) > 1 else None
+        self.by_model.setdefault(key, collections.deque()).append((next(self.arrivals), action))
+    
+    def add_first(self, action):
+        """Puts an action ahead of the waiting actions of its model"""
+        self.by_model.setdefault(id(action[1]), collections.deque()).appendleft((next(self.arrivals), action))
+    
+    def block(self, model):
+        self.blocked.add(id(model))
+    
+    def unblock(self, model):
+        self.blocked.discard(id(model))
+    
+    def estimate(self, action):
+        """Returns the estimated seconds applying action takes"""
+        return self.cost_per_unit.get(action[0], 0.0) * action_size(action)
+    
+    def cheapest(self):
+        """Returns (key, action, estimated seconds) of the next action to
+        apply, or None if there are none that can be applied"""
+        best = None
+        for key, actions in self.by_model.iteritems():
+            if key in self.blocked or (key is None and len(self.by_model) > 1):
+                continue
+            arrival, action = actions[0]
+            solid_angle = action[1].solid_angle if key is not None else 0.0
+            candidate = (self.estimate(action), -solid_angle, arrival, key, action)
+            if best is None or candidate < best:
+                best = candidate
+        if best is None:
+            return None
+        estimate, solid_angle, arrival, key, action = best
+        return key, action, estimate
+    
+    def pop(self, key):
+        actions = self.by_model[key]
+        actions.popleft()
+        if len(actions) == 0:
+            del self.by_model[key]
+    
+    def record(self, action, seconds):
+        """Updates the cost estimate of action's type with how long it took"""
+        per_unit = seconds / max(1, action_size(action))
+        previous = self.cost_per_unit.get(action[0])
+        if previous is None:
+            self.cost_per_unit[action[0]] = per_unit
+        else:
+            self.cost_per_unit[action[0]] = previous + ACTION_COST_SMOOTHING * (per_unit - previous)
+
+pending_actions = PendingActions()
 
 def checkForLoad(task):
     
     #print globalClock.getAverageFrameRate()
-    global model_queue
     
-    checkQueue()
-    
-    try:
-        action = load_queue.get_nowait()
-    except Queue.Empty:
-        action = None
+    while True:
+        try:
+            pending_actions.add(load_queue.get_nowait())
+        except Queue.Empty:
+            break
     
-    if EXIT_AFTER and action is None and base.num_models_loaded >= NUM_MODELS and base.quit and base.screenshot_frame > base.quit_frame:
+    # models whose download or load failed for good are never coming
+    num_models_done = base.num_models_loaded + base.num_models_failed
+    if EXIT_AFTER and len(pending_actions) == 0 and num_models_done >= NUM_MODELS and base.quit and base.screenshot_frame > base.quit_frame:
         sys.exit(0)
-    elif action is None and base.num_models_loaded >= NUM_MODELS and base.quit and base.screenshot_frame > base.quit_frame:
+    elif len(pending_actions) == 0 and num_models_done >= NUM_MODELS and base.quit and base.screenshot_frame > base.quit_frame:
         base.render.analyze()
         base.quit = False
     
-    if action is None:
-        return task.cont
+    # apply as many actions as fit in the frame budget, cheapest first,
+    # and leave the rest for the next frame. At least one action is applied
+    # every frame so that ones costlier than the budget still get through.
+    frame_start = time.time()
+    num_applied = 0
+    while True:
+        next_action = pending_actions.cheapest()
+        if next_action is None:
+            break
+        key, action, estimate = next_action
+        if num_applied > 0 and time.time() - frame_start + estimate > FRAME_BUDGET:
+            break
+        pending_actions.pop(key)
+        
+        start = time.time()
+        with tracing.span(ACTION_NAMES[action[0]]):
+            applyAction(action)
+        pending_actions.record(action, time.time() - start)
+        num_applied += 1
+    
+    return task.cont
 
+ACTION_NAMES = {ActionType.LOAD_MODEL: 'queue model load',
+                ActionType.UPDATE_TEXTURE: 'apply texture',
+                ActionType.PROGRESSIVE_ADDITION: 'apply refinements',
+                ActionType.QUIT: 'quit',
+                ActionType.ATTACH_MODEL: 'attach model',
+                ActionType.MODEL_FAILED: 'count failed model'}
+"""Names of the main thread's actions in traces"""
+
+def applyAction(action):
+    """Applies an action posted to load_queue by the loading thread"""
     action_type = action[0]
     
     if action_type == ActionType.LOAD_MODEL:
         model = action[1]
-        print 'Queueing model for load:', model.model_json['full_path'], 'queue size', len(model_queue)
-        model_queue.append(model)
-        checkQueue()
+        print 'Queueing model for load:', model.model_json['full_path'], 'queue size', len(pending_loads)
+        # the model's texture and refinement updates wait until it is attached
+        pending_actions.block(model)
+        pending_loads.add(model)
     
     elif action_type == ActionType.UPDATE_TEXTURE:
         model = action[1]
-        offset = action[2]
-        data = action[3]
-        print model.model_json['base_path'], 'needs texture updating offset', offset
-        texpnm = PNMImage()
-        texpnm.read(StringStream(data), 'something.jpg')
-        newtex = Texture()
-        newtex.load(texpnm)
+        texture_name = action[2]
+        offset = action[3]
+        newtex = action[4]
+        print model.model_json['base_path'], 'needs texture', texture_name, 'updating offset', offset
         
-        path_search = '**/*' + model.model_json['full_path'].replace('/', '_') + '*'
-        np = render.find(path_search)
+        nodes = model_nodes.get(model)
+        if nodes is None:
+            print 'model', model.model_json['full_path'], 'is not in the scene'
+            return
+        np = nodes.root
         
-        np.setTextureOff(1)
-        np.setTexture(newtex, 1)
+        # only the stages and geoms using this texture get the new level
+        old_textures = [tex for tex in np.findAllTextures() if tex.getName() == texture_name]
+        if len(old_textures) == 0:
+            print 'no texture named', texture_name, 'on', model.model_json['full_path']
+        for old_texture in old_textures:
+            np.replaceTexture(old_texture, newtex)
     
     elif action_type == ActionType.PROGRESSIVE_ADDITION:
         model = action[1]
         refinements = action[2]
         
-        path_search = '**/*' + model.model_json['full_path'].replace('/', '_') + '*'
-        np = render.find(path_search)
-        np = np.find("**/primitive")
-        pnode = np.node()
+        nodes = model_nodes.get(model)
+        if nodes is None:
+            print 'model', model.model_json['full_path'], 'is not in the scene'
+            return
+        pnode = nodes.primitive.node()
         
         
         start = time.time()
@@ -319,11 +568,21 @@ def checkForLoad(task):
     
         print '---JUST UPDATED ' + model.model_json['full_path'] + ' ----'
         
+    elif action_type == ActionType.ATTACH_MODEL:
+        modelLoaded(action[2], action[1])
+    
+    elif action_type == ActionType.MODEL_FAILED:
+        print 'model', action[1].model_json['full_path'], 'failed to load'
+        base.num_models_failed += 1
+    
     elif action_type == ActionType.QUIT:
         print 'Got a quit message, triggering quit flag'
         base.quit = True
-    
-    return task.cont
+
+def writeTrace(path):
+    tracing.write(path)
+    print 'Wrote trace to', path
+    print tracing.summary()
 
 def main():
     
@@ -335,6 +594,9 @@ def main():
     parser.add_argument('scene_file', help='Scene file to use, generated with scene_generator', type=argparse.FileType('r'))
     parser.add_argument('--screenshots', required=False, help='Directory to save screenshots', type=str)
     parser.add_argument('--exit-after-load', required=False, default=False, action='store_true', help='Exit the program after all models are loaded')
+    parser.add_argument('--priority-policy', choices=sorted(priority_policy.POLICIES), default='default', required=False, help='How load tasks are prioritized')
+    parser.add_argument('--trace', required=False, help='Write a Chrome trace of the load pipeline to this file on exit', type=str)
+    parser.add_argument('--blob-cache-size', required=False, default=blob_cache.MAX_CACHE_BYTES / (1024 * 1024), type=int, help='Size cap in MB for the on-disk CDN blob cache (0 disables it)')
     
     args = parser.parse_args()
     
@@ -353,6 +615,18 @@ def main():
     SAVE_SS = args.screenshots
     MODEL_TYPE = args.model_type
     MODEL_SUBTYPE = args.model_subtype
+    
+    priority_policy.set_policy(args.priority_policy)
+    
+    if args.trace is not None:
+        tracing.enable()
+        atexit.register(writeTrace, args.trace)
+    
+    blob_cache.set_max_bytes(args.blob_cache_size * 1024 * 1024)
+    if FORCE_MODEL_DOWNLOAD:
+        # start from an empty cache of this session's own rather than
+        # disabling it, so models sharing a hash still download it once
+        blob_cache.use_session_cache()
         
     if SAVE_SS is not None:
         if os.path.isdir(SAVE_SS):
@@ -374,6 +648,7 @@ def main():
     
     scene_dict = pickle.load(args.scene_file)
     HASH_SIZES = scene_dict['sizes']
+    open3dhub.HASH_SIZES = HASH_SIZES
     scene_models = scene_dict['models']
     NUM_MODELS = len(scene_models)
     
@@ -399,11 +674,17 @@ def main():
     base.cam.setPos(0, 30000, 10000)
     base.cam.lookAt(0, 0, 2000)
     
-    t = LoadingThread(scene_models)
+    cam_pos = base.cam.getPos(render)
+    cam_heading = base.cam.getQuat(render).getForward()
+    fov = base.camLens.getFov()
+    t = LoadingThread(scene_models, (cam_pos.getX(), cam_pos.getY(), cam_pos.getZ()),
+                      (cam_heading.getX(), cam_heading.getY(), cam_heading.getZ()),
+                      (fov[0], fov[1]))
     t.daemon = True
     t.start()
     
     taskMgr.add(checkForLoad, "checkForLoad")
+    taskMgr.add(trackCamera, "trackCamera", extraArgs=[t], appendTask=True)
     if SAVE_SS is not None:
         taskMgr.add(triggerScreenshot, "triggerScreenshot")
     
@@ -0,0 +1,315 @@
+"""Concurrent, connection-pooled HTTP fetching for the open3dhub CDN"""
+
+import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+NUM_FETCH_THREADS = 16
+"""Maximum number of requests in flight at once per process"""
+CONNECTIONS_PER_HOST = 8
+"""Maximum number of keep-alive connections kept open to a single host"""
+FETCH_TIMEOUT = 30.0
+"""Seconds to wait for a connection or for the next bytes of a response"""
+STREAM_CHUNK_SIZE = 64 * 1024
+"""Size of the chunks yielded by FetchEngine.stream"""
+COALESCE_GAP = 4096
+"""Ranges of one resource closer than this many bytes are fetched together"""
+FETCH_RETRIES = 3
+"""Times a request that failed with a transient error is tried again"""
+FETCH_RETRY_DELAY = 0.5
+"""Seconds before the first retry, doubled for each one after it"""
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+"""HTTP statuses that are worth retrying"""
+
+class FetchCancelled(Exception):
+    """Raised inside a fetch whose cancel check reported cancellation"""
+    pass
+
+_cancel_scope = threading.local()
+
+def set_cancel_check(check):
+    """Sets a callable for the calling thread that returns True once its
+    fetches should be aborted. Work it hands to the fetch threads is
+    checked against it too."""
+    _cancel_scope.check = check
+
+def get_cancel_check():
+    """Returns the cancel check of the calling thread, or None"""
+    return getattr(_cancel_scope, 'check', None)
+
+def check_cancelled():
+    """Raises FetchCancelled if the calling thread's fetches were cancelled"""
+    check = get_cancel_check()
+    if check is not None and check():
+        raise FetchCancelled()
+
+class FetchStats(object):
+    """Counts the bytes received over the network on behalf of one task"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, num_bytes):
+        with self.lock:
+            self.bytes += num_bytes
+
+def set_fetch_stats(stats):
+    """Sets the FetchStats that fetches made by the calling thread, and by
+    work it hands to the fetch threads, are counted in"""
+    _cancel_scope.stats = stats
+
+def get_fetch_stats():
+    """Returns the FetchStats of the calling thread, or None"""
+    return getattr(_cancel_scope, 'stats', None)
+
+def _count_fetched(num_bytes):
+    stats = get_fetch_stats()
+    if stats is not None:
+        stats.add(num_bytes)
+
+def _run_in_scope(check, stats, func, args):
+    set_cancel_check(check)
+    set_fetch_stats(stats)
+    try:
+        check_cancelled()
+        return func(*args)
+    finally:
+        set_cancel_check(None)
+        set_fetch_stats(None)
+
+class FetchEngine(object):
+    """Runs HTTP GET requests on a pool of threads that share a bounded
+    pool of keep-alive connections per host"""
+
+    def __init__(self, num_threads=None, connections_per_host=None, timeout=FETCH_TIMEOUT):
+        if num_threads is None:
+            num_threads = NUM_FETCH_THREADS
+        if connections_per_host is None:
+            connections_per_host = CONNECTIONS_PER_HOST
+        self.timeout = timeout
+        self.session = requests.session()
+        # pool_block makes callers wait for a free connection instead of
+        # opening (and then throwing away) extra ones
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=connections_per_host,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPool(num_threads)
+
+    def _get(self, url, httprange, timeout, stream=False):
+        headers = {}
+        if httprange is not None:
+            offset, length = httprange
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset+length-1)
+
+        if timeout is None:
+            timeout = self.timeout
+
+        delay = FETCH_RETRY_DELAY
+        for attempt in range(FETCH_RETRIES + 1):
+            retry = attempt < FETCH_RETRIES
+            try:
+                resp = self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if not retry:
+                    raise
+            else:
+                if not retry or resp.status_code not in RETRY_STATUSES:
+                    resp.raise_for_status()
+                    return resp
+                resp.close()
+            print 'retrying', url, 'in', delay, 'seconds'
+            time.sleep(delay)
+            delay *= 2
+            check_cancelled()
+
+    def fetch(self, url, httprange=None, timeout=None):
+        """Fetches the given URL in the calling thread and returns its data.
+        httprange is an optional (offset, length) tuple."""
+        if get_cancel_check() is None:
+            data = self._get(url, httprange, timeout).content
+            _count_fetched(len(data))
+            return data
+        # read in chunks so a cancel can abort the transfer part way
+        return ''.join(self.stream(url, httprange, timeout=timeout))
+
+    def stream(self, url, httprange=None, chunk_size=STREAM_CHUNK_SIZE, timeout=None):
+        """Fetches the given URL in the calling thread, yielding its data in
+        chunks as they arrive. Raises FetchCancelled between chunks if the
+        thread's fetches are cancelled."""
+        check_cancelled()
+        resp = self._get(url, httprange, timeout, stream=True)
+        try:
+            for chunk in resp.iter_content(chunk_size):
+                check_cancelled()
+                _count_fetched(len(chunk))
+                yield chunk
+        finally:
+            resp.close()
+
+    def submit(self, func, *args):
+        """Runs func(*args) on the fetch threads and returns an AsyncResult.
+        func must not wait on other work submitted to this engine. The
+        caller's cancel check and fetch stats apply to it."""
+        return self.pool.apply_async(_run_in_scope, (get_cancel_check(), get_fetch_stats(), func, args))
+
+    def fetch_async(self, url, httprange=None, timeout=None):
+        """Starts fetching the given URL and returns an AsyncResult for its data"""
+        return self.submit(self.fetch, url, httprange, timeout)
+
+    def fetch_many(self, urls_and_ranges, timeout=None):
+        """Fetches a list of (url, httprange) tuples concurrently and returns
+        their data in the same order"""
+        pending = [self.fetch_async(url, httprange, timeout) for url, httprange in urls_and_ranges]
+        return [result.get() for result in pending]
+
+    def probe_size(self, url, timeout=None):
+        """Returns (size, gzip_size) for the given URL without downloading
+        its body, or None if the server doesn't report both.
+
+        size comes from the Content-Range total of a 1 byte, uncompressed
+        range request and gzip_size from the Content-Length of a HEAD."""
+        if timeout is None:
+            timeout = self.timeout
+
+        resp = self.session.get(url, headers={'Range': 'bytes=0-0',
+                                              'Accept-Encoding': 'identity'},
+                                timeout=timeout)
+        resp.raise_for_status()
+        content_range = resp.headers.get('content-range')
+        if resp.status_code != 206 or content_range is None:
+            return None
+        total = content_range.rsplit('/', 1)[-1]
+        if not total.isdigit():
+            return None
+        size = int(total)
+
+        resp = self.session.head(url, timeout=timeout)
+        resp.raise_for_status()
+        content_length = resp.headers.get('content-length')
+        if content_length is None:
+            return None
+        if resp.headers.get('content-encoding') != 'gzip':
+            return size, size
+        return size, int(content_length)
+
+    def map_unordered(self, func, items):
+        """Runs func over items on the fetch threads, yielding results as
+        they complete"""
+        return self.pool.imap_unordered(func, items)
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """Makes concurrent calls for the same key share one execution. The
+    first caller runs the call, and callers arriving while it is in flight
+    wait for it and get its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args):
+        """Runs func(*args), or waits for the call already in flight for
+        key. Returns (value, leader), where leader is True for the caller
+        that actually ran func.
+
+        A waiting caller whose own fetches are cancelled raises
+        FetchCancelled, and one whose leader was cancelled runs the call
+        itself."""
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _Flight()
+                    self.flights[key] = flight
+
+            if leader:
+                try:
+                    flight.value = func(*args)
+                    return flight.value, True
+                except BaseException as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self.lock:
+                        del self.flights[key]
+                    flight.done.set()
+
+            if get_cancel_check() is None:
+                flight.done.wait()
+            else:
+                while not flight.done.wait(0.1):
+                    check_cancelled()
+
+            if isinstance(flight.error, FetchCancelled):
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, False
+
+def coalesce_ranges(ranges, max_gap=COALESCE_GAP):
+    """Plans requests for a list of (offset, length) ranges of one resource,
+    merging ranges that overlap or are within max_gap bytes of each other.
+
+    Returns a list of ((offset, length), indices) tuples, one per request,
+    where indices are the positions in ranges that the request covers."""
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+
+    plans = []
+    start = end = None
+    members = []
+    for i in order:
+        offset, length = ranges[i]
+        if start is not None and offset <= end + max_gap:
+            end = max(end, offset + length)
+            members.append(i)
+        else:
+            if start is not None:
+                plans.append(((start, end - start), members))
+            start = offset
+            end = offset + length
+            members = [i]
+    if start is not None:
+        plans.append(((start, end - start), members))
+
+    return plans
+
+_ENGINE = None
+_ENGINE_PID = None
+_ENGINE_LOCK = threading.Lock()
+
+def set_max_transfers(max_transfers):
+    """Sizes the fetch engine for up to max_transfers tasks fetching at once.
+    Tasks fetch on their own threads and hand more fetches to the fetch
+    threads, so there are as many fetch threads and a connection for each
+    thread of either kind. Otherwise a concurrency limit above the pool
+    size only queues tasks for a connection. Call before any fetches."""
+    global NUM_FETCH_THREADS, CONNECTIONS_PER_HOST, _ENGINE
+    NUM_FETCH_THREADS = max_transfers
+    CONNECTIONS_PER_HOST = 2 * max_transfers
+    with _ENGINE_LOCK:
+        _ENGINE = None
+
+def get_engine():
+    """Returns the fetch engine for this process. Forked pool workers get
+    their own engine instead of sharing the parent's sockets and threads."""
+    global _ENGINE, _ENGINE_PID
+
+    pid = os.getpid()
+    with _ENGINE_LOCK:
+        if _ENGINE is None or _ENGINE_PID != pid:
+            _ENGINE = FetchEngine()
+            _ENGINE_PID = pid
+    return _ENGINE
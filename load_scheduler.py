@@ -1,10 +1,21 @@
 import open3dhub
+import spool
+import fetcher
+import tracing
+import priority_policy
 import multiprocessing
-import heapq
+from multiprocessing.pool import ThreadPool
+import sys
 import time
 import math
+import threading
+import traceback
 from collections import namedtuple
 
+BASE_MODEL_TYPES = {'optimized_unflattened': 'optimized',
+                    'progressive_full': 'progressive'}
+"""Model types that are loaded from the metadata of another type"""
+
 class Model(object):
     def __init__(self, model_json, model_type, x, y, z, scale):
         self.model_json = model_json
@@ -13,11 +24,28 @@ class Model(object):
         self.z = z
         self.scale = scale
         self.solid_angle = 0.0
+        self.screen_solid_angle = None
+        """Unweighted solid angle the model covers on screen, or None if
+        not known"""
         self.model_type = model_type
         self.model_subtype = None
         self.subfile_hashes = []
         self.bam_file = None
     
+    def compact(self):
+        """Returns a copy of this model that only carries the parts of its
+        JSON needed to download and load its current type, for handing to
+        workers"""
+        model = Model.__new__(Model)
+        model.__dict__.update(self.__dict__)
+        
+        types = self.model_json['metadata']['types']
+        type_names = [self.model_type, BASE_MODEL_TYPES.get(self.model_type)]
+        model.model_json = dict((key, self.model_json[key]) for key in ('base_path', 'full_path', 'version_num')
+                                if key in self.model_json)
+        model.model_json['metadata'] = {'types': dict((name, types[name]) for name in type_names if name in types)}
+        return model
+    
     def __str__(self):
         return "<Model '%s' at (%.7g,%.7g,%.7g) scale %.7g>" % (self.model_json['base_path'], self.x, self.y, self.z, self.scale)
     def __repr__(self):
@@ -26,6 +54,10 @@ class Model(object):
 class Task(object):
     """Base class for tasks that need to be executed"""
     
+    preemptible = False
+    """Whether a running task can be aborted to make room for a much
+    higher priority one and then queued again"""
+    
     def __init__(self, priority, dependents=None):
         """Creates a task with given priority and list of dependent tasks"""
         self.priority = priority
@@ -33,6 +65,16 @@ class Task(object):
             self.dependents = []
         else:
             self.dependents = dependents
+        self.cancelled = False
+        self.preempted = False
+        self.failures = 0
+        self.cancel_slot = None
+        self.started = None
+        self.bytes_fetched = 0
+        self.trace_id = None
+        self.trace_parent = None
+        self.trace_enqueued = None
+        self.trace_priority = None
 
     def run(self, pool):
         """Called when the task should be run, implemented by child classes"""
@@ -42,6 +84,16 @@ class Task(object):
         """Called when the result of a task is complete, implemented by child classes"""
         raise NotImplementedError
     
+    def dedup_key(self):
+        """Returns a key under which tasks producing the same result share
+        one run, or None if the task always runs"""
+        return None
+    
+    def discard(self):
+        """Called instead of run() when the task's result came from another
+        task with the same dedup key, or when it was cancelled before running"""
+        pass
+    
     def __cmp__(self, other):
         """Reverse compare function so that heapq will return largest priority first"""
         if self.priority == other.priority:
@@ -53,6 +105,8 @@ class Task(object):
 class DownloadTask(Task):
     """Base task class for downloading something"""
     
+    preemptible = True
+    
     def __init__(self, *args, **kwargs):
         super(DownloadTask, self).__init__(*args, **kwargs)
         
@@ -68,15 +122,24 @@ class ModelDownloadTask(DownloadTask):
     def __init__(self, model, *args, **kwargs):
         super(ModelDownloadTask, self).__init__(*args, **kwargs)
         self.model = model
+        self.scored_solid_angle = model.solid_angle
     
     def run(self, pool):
-        return pool.apply_async(execute_download, (self.model,))
+        return pool.apply_async(execute_download, (self.model.compact(),))
     
     def finished(self, result):
         print 'finished download task'
         for subtask in result:
+            rebind_model(subtask, self.model)
             self.dependents.append(subtask)
 
+def rebind_model(task, model):
+    """Points a task that came back from a worker, and its dependents, at
+    this process's model instead of the worker's copy of it"""
+    task.model = model
+    for dependent in task.dependents:
+        rebind_model(dependent, model)
+
 def execute_download(model):
     """Execute function for a ModelDownloadTask"""
     return open3dhub.download_mesh_and_subtasks(model)
@@ -84,152 +147,651 @@ def execute_download(model):
 class TextureDownloadTask(DownloadTask):
     """Task for downloading a texture from CDN"""
     
-    def __init__(self, model, offset, *args, **kwargs):
+    def __init__(self, model, tar_hash, texture_name, mipmap_levels, level, shown_pixels=0, fetch_length=None,
+                 *args, **kwargs):
         super(TextureDownloadTask, self).__init__(*args, **kwargs)
         self.model = model
-        self.offset = offset
+        self.scored_solid_angle = model.solid_angle
+        self.tar_hash = tar_hash
+        self.texture_name = texture_name
+        self.mipmap_levels = mipmap_levels
+        self.level = level
+        self.shown_pixels = shown_pixels
+        """Pixels of the texture level shown before this one"""
+        self.offset = mipmap_levels[level]['offset']
+        self.length = mipmap_levels[level]['length']
+        self.fetch_length = fetch_length
         self.data = None
     
     def run(self, pool):
-        return pool.apply_async(execute_texture_download, (self.model, self.offset))
+        return pool.apply_async(execute_texture_download, (self.tar_hash, self.offset, self.length, self.fetch_length))
     
     def finished(self, result):
         print 'finished texture download task'
         self.data = result
+        
+        # the next level is picked now rather than when the model was
+        # planned, from the throughput and screen size at this point
+        mipmap = self.mipmap_levels[self.level]
+        next_texture_task = open3dhub.texture_download_task(self.model, self.tar_hash, self.texture_name,
+                                                            self.mipmap_levels, mipmap['width'] * mipmap['height'])
+        if next_texture_task is not None:
+            self.dependents.append(next_texture_task)
+
+def texture_needed(task):
+    """Returns True if a texture task's level adds detail its model can show
+    at its current size on screen"""
+    return not open3dhub.texture_covers_screen(task.model, task.shown_pixels)
 
-def execute_texture_download(model, offset):
+class ParkedTextures(object):
+    """Texture levels held out of the pools because their model already
+    shows a texture as detailed as it needs. A texture's chain of levels
+    stops there, and picks its next level again once its model grows on
+    screen."""
+    
+    def __init__(self):
+        self.tasks = []
+    
+    def __len__(self):
+        return len(self.tasks)
+    
+    def park(self, task):
+        """Holds task back and returns True if it is a texture level its
+        model doesn't need now, otherwise returns False"""
+        if not isinstance(task, TextureDownloadTask) or texture_needed(task):
+            return False
+        self.tasks.append(task)
+        return True
+    
+    def park_waiting(self, pool):
+        """Takes the waiting texture levels that their models no longer need
+        out of pool and holds them back. Returns how many were parked."""
+        tasks = [task for task in pool.to_run if isinstance(task, TextureDownloadTask) and not texture_needed(task)]
+        for task in tasks:
+            pool.remove_task(task)
+        self.tasks.extend(tasks)
+        return len(tasks)
+    
+    def resume(self):
+        """Returns a new task for the next level of each parked texture whose
+        model now needs more detail than it shows"""
+        resumed = []
+        parked = []
+        for task in self.tasks:
+            if not texture_needed(task):
+                parked.append(task)
+                continue
+            # the level was picked for the old screen size and throughput
+            texture_task = open3dhub.texture_download_task(task.model, task.tar_hash, task.texture_name,
+                                                           task.mipmap_levels, task.shown_pixels)
+            if texture_task is not None:
+                resumed.append(texture_task)
+        self.tasks = parked
+        return resumed
+
+def execute_texture_download(tar_hash, offset, length, fetch_length):
     """Execute function for a TextureDownloadTask"""
-    return open3dhub.download_texture(model, offset)
+    return open3dhub.download_texture(tar_hash, offset, length, fetch_length)
     
 class ProgressiveDownloadTask(DownloadTask):
     """Task for downloading progressive stream"""
     
-    def __init__(self, model, offset, length, refinements_read, num_refinements, previous_data, *args, **kwargs):
+    def __init__(self, model, offset, length, decoder, *args, **kwargs):
         super(ProgressiveDownloadTask, self).__init__(*args, **kwargs)
         self.model = model
+        self.scored_solid_angle = model.solid_angle
         self.offset = offset
         self.length = length
-        self.refinements_read = refinements_read
-        self.num_refinements = num_refinements
-        self.previous_data = previous_data
+        self.decoder = decoder
+        self.progressive_hash = model.model_json['metadata']['types'][model.model_type]['progressive_stream']
     
     def run(self, pool):
-        return pool.apply_async(execute_progressive_download, (self.model, self.offset, self.length, self.refinements_read, self.num_refinements, self.previous_data))
+        return pool.apply_async(execute_progressive_download, (self.progressive_hash, self.offset, self.length, self.decoder))
     
     def finished(self, result):
         print 'finished progressive download task'
-        refinements_read, num_refinements, refinements, previous_data = result
+        decoder, refinements = result
         
         self.refinements = refinements
         
-        types = self.model.model_json['metadata']['types']
-        type_dict = types[self.model.model_type]
-        progressive_hash = type_dict['progressive_stream']
-        
-        # priority is the solid angle
-        priority = self.model.solid_angle
-        # multiplied by a scale factor that makes earlier chunks have more weight
-        percentage = float(self.offset + self.length + open3dhub.PROGRESSIVE_CHUNK_SIZE) / self.model.HASH_SIZES[progressive_hash]['size']
-        priority = priority * ((1.0 - percentage) ** 2)
-        # divided by the gzip size
-        priority = priority / self.model.HASH_SIZES[progressive_hash]['gzip_size']
-        
-        if refinements_read < num_refinements:
+        if not decoder.done:
+            offset = self.offset + self.length
+            chunk_size = open3dhub.progressive_chunk_size(self.progressive_hash, offset, decoder)
+            priority = priority_policy.get_policy().progressive_priority(self.model,
+                                                                         self.progressive_hash,
+                                                                         offset,
+                                                                         chunk_size)
             next_progressive_task = ProgressiveDownloadTask(self.model,
-                                                            self.offset + self.length,
-                                                            open3dhub.PROGRESSIVE_CHUNK_SIZE,
-                                                            refinements_read = refinements_read,
-                                                            num_refinements = num_refinements,
-                                                            previous_data = previous_data,
+                                                            offset,
+                                                            chunk_size,
+                                                            decoder = decoder,
                                                             priority = priority)
             self.dependents.append(next_progressive_task)
             
     def __str__(self):
-        return '<ProgressiveDownloadTask refinements_read=%s, num_refinements=%s>' % (self.refinements_read, self.num_refinements)
+        return '<ProgressiveDownloadTask refinements_read=%s, num_refinements=%s>' % (self.decoder.refinements_read, self.decoder.num_refinements)
     def __repr__(self):
         return str(self)
 
-def execute_progressive_download(model, offset, length, refinements_read, num_refinements, previous_data):
+def execute_progressive_download(progressive_hash, offset, length, decoder):
     """Execute function for a ProgressiveDownloadTask"""
-    return open3dhub.download_progressive(model, offset, length, refinements_read, num_refinements, previous_data)
+    return open3dhub.download_progressive(progressive_hash, offset, length, decoder)
 
 class LoadTask(Task):
     """Task for loading a model using pycollada and turning it into 
-    a bam file for loading"""
+    a bam file for loading. meshdata and the values of subfiles are
+    spool.Payload handles."""
     
-    def __init__(self, meshdata, subfiles, model, is_bam=False, *args, **kwargs):
+    def __init__(self, meshdata, subfiles, model, is_bam=False, prog_data=None, *args, **kwargs):
         super(LoadTask, self).__init__(*args, **kwargs)
         self.meshdata = meshdata
         self.subfiles = subfiles
         self.model = model
+        self.scored_solid_angle = model.solid_angle
         self.is_bam = is_bam
+        self.prog_data = prog_data
     
     def run(self, pool):
         torun = execute_load
         if self.is_bam:
             torun = null_load
-        return pool.apply_async(torun, (self.meshdata, self.subfiles, self.model))
+        return pool.apply_async(torun, (self.meshdata, self.subfiles, self.model.compact(), self.prog_data))
     
     def finished(self, result):
         print 'finished load task'
+    
+    def dedup_key(self):
+        # instances of the same asset write the same bam file
+        return self.model.bam_file
+    
+    def discard(self):
+        release_payloads(self.meshdata)
         
-def null_load(meshdata, subfiles, model):
-    f = open(model.bam_file, 'wb')
-    f.write(meshdata)
-    f.close()
+def null_load(meshdata, subfiles, model, prog_data=None):
+    try:
+        f = open(model.bam_file, 'wb')
+        f.write(spool.read(meshdata))
+        f.close()
+    finally:
+        release_payloads(meshdata)
     return model.bam_file
         
-def execute_load(meshdata, subfiles, model):
+def execute_load(meshdata, subfiles, model, prog_data=None):
     """Execute function for LoadTask"""
-    return open3dhub.load_into_bamfile(meshdata, subfiles, model)
+    try:
+        return open3dhub.load_into_bamfile(meshdata, subfiles, model, prog_data)
+    finally:
+        release_payloads(meshdata)
+
+def release_payloads(meshdata):
+    """Removes the spool file a LoadTask's payloads were written to"""
+    if isinstance(meshdata, spool.Payload):
+        meshdata.release()
     
 
+def rescale_priority(task):
+    """Returns the priority of a task rescaled to its model's current solid
+    angle. Every task priority is proportional to the solid angle of its
+    model at the time the task was created."""
+    new_angle = task.model.solid_angle
+    old_angle = task.scored_solid_angle
+    if new_angle != old_angle and old_angle > 0:
+        task.priority = task.priority * (new_angle / old_angle)
+        task.scored_solid_angle = new_angle
+    return task.priority
+
+class IndexedHeap(object):
+    """A heap of tasks, highest priority first, that can change the
+    priority of or remove a task already in it"""
+    
+    def __init__(self):
+        self.heap = []
+        self.index = {}
+        """Maps id(task) to its position in heap"""
+    
+    def __len__(self):
+        return len(self.heap)
+    
+    def __iter__(self):
+        return iter(list(self.heap))
+    
+    def __contains__(self, task):
+        return id(task) in self.index
+    
+    def _set(self, pos, task):
+        self.heap[pos] = task
+        self.index[id(task)] = pos
+    
+    def _sift_up(self, pos):
+        task = self.heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if self.heap[parent].priority >= task.priority:
+                break
+            self._set(pos, self.heap[parent])
+            pos = parent
+        self._set(pos, task)
+    
+    def _sift_down(self, pos):
+        task = self.heap[pos]
+        size = len(self.heap)
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and self.heap[child + 1].priority > self.heap[child].priority:
+                child += 1
+            if task.priority >= self.heap[child].priority:
+                break
+            self._set(pos, self.heap[child])
+            pos = child
+        self._set(pos, task)
+    
+    def push(self, task):
+        """Adds a task"""
+        self.heap.append(task)
+        self._sift_up(len(self.heap) - 1)
+    
+    def peek(self):
+        """Returns the highest priority task without removing it"""
+        return self.heap[0]
+    
+    def pop(self):
+        """Removes and returns the highest priority task"""
+        return self.remove(self.heap[0])
+    
+    def remove(self, task):
+        """Removes the given task"""
+        pos = self.index.pop(id(task))
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self._set(pos, last)
+            self._sift_up(pos)
+            self._sift_down(self.index[id(last)])
+        return task
+    
+    def update(self, task, priority):
+        """Changes the priority of a task in the heap"""
+        task.priority = priority
+        pos = self.index[id(task)]
+        self._sift_up(pos)
+        self._sift_down(self.index[id(task)])
+    
+    def reprioritize(self, score):
+        """Sets the priority of every task to score(task) in one pass"""
+        for task in self.heap:
+            task.priority = score(task)
+        for pos in reversed(range(len(self.heap) // 2)):
+            self._sift_down(pos)
+
 TaskResult = namedtuple('TaskResult', 'task, result')
 """A task and its result"""
 
+NUM_CANCEL_SLOTS = 1024
+"""Number of cancel flags shared with each pool's workers"""
+PREEMPT_RATIO = 100.0
+"""A waiting task preempts a running one if its priority is this many times higher"""
+PREEMPT_MIN_SECONDS = 1.0
+"""Only tasks that have been running at least this long get preempted"""
+TASK_RETRIES = 2
+"""Times a failed download task is queued again before it is dropped"""
+
+class TaskStatus(object):
+    DONE = 0
+    FAILED = 1
+    CANCELLED = 2
+
+CANCEL_FLAGS = None
+"""The cancel flags of the pool this worker process belongs to"""
+
+def init_worker(cancel_flags):
+    """Initializer for pool workers, which inherit the pool's cancel flags"""
+    global CANCEL_FLAGS
+    CANCEL_FLAGS = cancel_flags
+
+def call_task(func, args, cancel_slot=None, cancel_flags=None):
+    """Runs a task's execute function in the pool. Exceptions are returned
+    instead of raised so the completion callback always fires. Fetches made
+    by func abort once the task's cancel flag is set. Worker processes use
+    the cancel flags they inherited unless cancel_flags is given.
+    
+    Returns (status, value, info), where info is a tracing.RunInfo with the
+    number of bytes func downloaded."""
+    if cancel_flags is None:
+        cancel_flags = CANCEL_FLAGS
+    if cancel_slot is not None:
+        fetcher.set_cancel_check(lambda: cancel_flags[cancel_slot] != 0)
+    stats = fetcher.FetchStats()
+    fetcher.set_fetch_stats(stats)
+    tracing.begin_collect()
+    started = time.time()
+    try:
+        status, value = TaskStatus.DONE, func(*args)
+    except fetcher.FetchCancelled:
+        status, value = TaskStatus.CANCELLED, None
+    except Exception:
+        status, value = TaskStatus.FAILED, traceback.format_exc()
+    finally:
+        fetcher.set_cancel_check(None)
+        fetcher.set_fetch_stats(None)
+    info = tracing.RunInfo(bytes=stats.bytes, worker=tracing.worker_name(), started=started,
+                           finished=time.time(), spans=tracing.end_collect())
+    return status, value, info
+
+class ProcessExecutor(object):
+    """Runs tasks in worker processes. Task arguments and results are
+    pickled to and from the workers, so this suits CPU bound tasks."""
+    
+    def __init__(self, num_workers, cancel_flags):
+        self.pool = multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(cancel_flags,))
+    
+    def submit(self, func, args, cancel_slot, callback):
+        return self.pool.apply_async(call_task, (func, args, cancel_slot), callback=callback)
+
+class ThreadExecutor(object):
+    """Runs tasks on threads of the calling process. Nothing is pickled, so
+    this suits I/O bound tasks whose arguments are big but cheap to run."""
+    
+    def __init__(self, num_workers, cancel_flags):
+        self.cancel_flags = cancel_flags
+        self.pool = ThreadPool(num_workers)
+    
+    def submit(self, func, args, cancel_slot, callback):
+        return self.pool.apply_async(call_task, (func, args, cancel_slot, self.cancel_flags), callback=callback)
+
+class TaskRunner(object):
+    """What a task's run() is given in place of the pool. Reports the task's
+    completion back to its TaskPool as soon as the result lands."""
+    
+    def __init__(self, taskpool, task):
+        self.taskpool = taskpool
+        self.task = task
+    
+    def apply_async(self, func, args=()):
+        def completed(outcome):
+            self.taskpool.task_completed(self.task, outcome)
+        return self.taskpool.executor.submit(func, args, self.task.cancel_slot, completed)
+
 class TaskPool(object):
     """A task pool for running tasks"""
     
-    def __init__(self, NUM_PROCS):
-        """Initializes the pool with given number of processes"""
+    def __init__(self, NUM_PROCS, wakeup=None, preempt=False, executor=ProcessExecutor, controller=None, name='pool'):
+        """Initializes the pool with given number of workers, run by the
+        given executor class. Pools that should be waited on together with
+        wait_any share a wakeup condition. If preempt is True, long running
+        preemptible tasks are aborted and queued again when a much higher
+        priority task is waiting. A concurrency controller, if given, picks
+        how many of the workers are used at a time. name labels the pool's
+        tasks in traces."""
         self.NUM_PROCS = NUM_PROCS
-        self.pool = multiprocessing.Pool(self.NUM_PROCS)
-        self.to_run = []
+        self.name = name
+        self.controller = controller
+        if controller is None:
+            self.concurrency = NUM_PROCS
+        else:
+            self.concurrency = min(NUM_PROCS, controller.limit)
+        self.cancel_flags = multiprocessing.RawArray('b', NUM_CANCEL_SLOTS)
+        self.free_slots = range(NUM_CANCEL_SLOTS)
+        self.executor = executor(self.NUM_PROCS, self.cancel_flags)
+        self.to_run = IndexedHeap()
         self.running = []
+        if wakeup is None:
+            wakeup = threading.Condition()
+        self.wakeup = wakeup
+        self.completed = []
+        self.preempt = preempt
+        # tasks waiting on a running task with the same dedup key, and the
+        # results of finished ones, which are reused for the whole session
+        self.followers = {}
+        self.shared_results = {}
+        self.shared_finished = []
+        # tasks dropped after failing, along with their dependents, until
+        # the owner of the pool takes them
+        self.failed = []
 
     def add_task(self, task):
         """Add a task to the pool"""
-        heapq.heappush(self.to_run, task)
+        # dependents may have been created before a change of view
+        rescale_priority(task)
+        tracing.task_enqueued(task)
+        self.to_run.push(task)
+
+    def update_priority(self, task, priority):
+        """Changes the priority of a waiting task"""
+        self.to_run.update(task, priority)
+
+    def remove_task(self, task):
+        """Removes a waiting task from the pool"""
+        self.to_run.remove(task)
+
+    def reprioritize(self, score=rescale_priority):
+        """Rescores every waiting task with score(task)"""
+        self.to_run.reprioritize(score)
+
+    def task_completed(self, task, outcome):
+        """Called from the pool's result thread when a task finishes"""
+        with self.wakeup:
+            self.completed.append((task, outcome))
+            self.wakeup.notify_all()
+
+    def has_completed(self):
+        """Returns True if there are completed tasks waiting for poll()"""
+        return len(self.completed) > 0
 
     def check_waiting(self):
-        """Checks list of running tasks for any that have finished"""
-        finished = []
-        new_running = []
-        for runningtask in self.running:
-            if runningtask.result.ready():
-                finished.append(runningtask)
-            else:
-                new_running.append(runningtask)
-        self.running = new_running
+        """Collects the running tasks that have finished, as (task, outcome)"""
+        with self.wakeup:
+            finished = self.completed
+            self.completed = []
+        
+        done = set(id(task) for task, outcome in finished)
+        self.running = [runningtask for runningtask in self.running if id(runningtask.task) not in done]
         return finished
 
+    def cancel(self, task):
+        """Cancels a task. A waiting task is removed from the pool, and a
+        running one has its transfers aborted. Either way it never finishes,
+        so its dependents are never scheduled."""
+        task.cancelled = True
+        if task in self.to_run:
+            self.to_run.remove(task)
+            task.discard()
+            return
+        for followers in self.followers.itervalues():
+            # tasks compare by priority, so look for this one by identity
+            remaining = [follower for follower in followers if follower is not task]
+            if len(remaining) < len(followers):
+                followers[:] = remaining
+                task.discard()
+                return
+        if task.cancel_slot is not None:
+            self.cancel_flags[task.cancel_slot] = 1
+
+    def _waiting_followers(self):
+        return [task for followers in self.followers.itervalues() for task in followers]
+
+    def cancel_where(self, predicate):
+        """Cancels every waiting or running task for which predicate(task) is
+        True. Returns the number of tasks cancelled."""
+        to_cancel = [task for task in self.to_run if predicate(task)]
+        to_cancel += [task for task in self._waiting_followers()
+                      if not task.cancelled and predicate(task)]
+        to_cancel += [runningtask.task for runningtask in self.running
+                      if not runningtask.task.cancelled and predicate(runningtask.task)]
+        for task in to_cancel:
+            self.cancel(task)
+        return len(to_cancel)
+
+    def check_preemption(self):
+        """Aborts the lowest priority long running task if the best waiting
+        task has a much higher priority. The aborted task is queued again
+        when its abort is reported."""
+        if not self.preempt or len(self.to_run) == 0 or len(self.running) < self.concurrency:
+            return
+        if any(runningtask.task.preempted for runningtask in self.running):
+            return
+        
+        now = time.time()
+        candidates = [runningtask.task for runningtask in self.running
+                      if runningtask.task.preemptible and not runningtask.task.cancelled
+                      and runningtask.task.cancel_slot is not None
+                      and now - runningtask.task.started >= PREEMPT_MIN_SECONDS]
+        if len(candidates) == 0:
+            return
+        
+        victim = min(candidates, key=lambda task: task.priority)
+        if self.to_run.peek().priority > victim.priority * PREEMPT_RATIO:
+            print 'preempting', victim
+            victim.preempted = True
+            self.cancel_flags[victim.cancel_slot] = 1
+
+    def _dispatch(self, task):
+        key = task.dedup_key()
+        if key is not None:
+            if key in self.shared_results:
+                task.discard()
+                self.shared_finished.append((task, self.shared_results[key]))
+                return
+            if key in self.followers:
+                print 'sharing the result of a running task with', task
+                self.followers[key].append(task)
+                return
+            self.followers[key] = []
+        
+        if len(self.free_slots) > 0:
+            task.cancel_slot = self.free_slots.pop()
+            self.cancel_flags[task.cancel_slot] = 0
+        task.started = time.time()
+        tracing.task_dispatched(task)
+        self.running.append(TaskResult(task=task, result=task.run(TaskRunner(self, task))))
+
+    def _release(self, task):
+        if task.cancel_slot is not None:
+            self.free_slots.append(task.cancel_slot)
+            task.cancel_slot = None
+
+    def _release_followers(self, task, status, result):
+        """Hands the outcome of a task that ran to the tasks that were
+        waiting on it with the same dedup key. Returns the followers that
+        finished with it."""
+        key = task.dedup_key()
+        if key is None:
+            return []
+        followers = []
+        for follower in self.followers.pop(key, []):
+            if follower.cancelled:
+                follower.discard()
+            else:
+                followers.append(follower)
+        
+        if status != TaskStatus.DONE or task.cancelled:
+            # nothing to share, so the followers run on their own and the
+            # first of them to be dispatched takes over
+            for follower in followers:
+                self.to_run.push(follower)
+            return []
+        
+        self.shared_results[key] = result
+        for follower in followers:
+            follower.discard()
+            follower.finished(result)
+        return followers
+
     def empty(self):
         """Returns True if the pool is empty"""
-        return len(self.to_run) + len(self.running) == 0
+        return len(self.to_run) + len(self.running) + len(self._waiting_followers()) == 0
 
     def poll(self):
-        """Executes tasks and gets results. Should be executed often."""
+        """Executes tasks and gets results. Doesn't block; use wait() or
+        wait_any() to sleep until there is something to do."""
         finished_running = self.check_waiting()
-
-        while len(self.running) < self.NUM_PROCS and len(self.to_run) > 0:
-            task = heapq.heappop(self.to_run)
-            self.running.append(TaskResult(task=task, result=task.run(self.pool)))
         
         to_return = []
-        for runningtask in finished_running:
+        for task, (status, result, info) in finished_running:
+            self._release(task)
+            task.bytes_fetched = info.bytes
+            tracing.task_finished(task, self.name, status, info)
+            shared_with = self._release_followers(task, status, result)
+            
+            if task.preempted:
+                task.preempted = False
+                if status == TaskStatus.CANCELLED and not task.cancelled:
+                    print 'requeueing preempted task', task
+                    tracing.task_enqueued(task)
+                    self.to_run.push(task)
+                    continue
+            
+            if task.cancelled or status == TaskStatus.CANCELLED:
+                print 'dropping cancelled task', task
+                # the task may have been cancelled before it got to its payloads
+                task.discard()
+                continue
+            
+            if status == TaskStatus.FAILED:
+                task.failures += 1
+                if task.preemptible and task.failures <= TASK_RETRIES:
+                    # downloads mostly fail on transient network errors
+                    print 'requeueing failed task', task, 'after', task.failures, 'failures'
+                    tracing.task_enqueued(task)
+                    self.to_run.push(task)
+                    continue
+                print >> sys.stderr, 'dropping failed task', task, 'and its dependents'
+                print >> sys.stderr, result
+                task.discard()
+                self.failed.append(task)
+                continue
+            
             print 'taskpool finished a task', len(self.to_run) + len(self.running), 'left'
-            result = runningtask.result.get()
-            runningtask.task.finished(result)
-            to_return.append(runningtask.task)
+            if self.controller is not None:
+                self.controller.task_finished(task, info.finished - info.started, info.bytes)
+            task.finished(result)
+            tracing.set_parent(task.dependents, task)
+            to_return.append(task)
+            to_return.extend(shared_with)
+
+        if self.controller is not None:
+            self.concurrency = min(self.NUM_PROCS, self.controller.update(self))
+        self.check_preemption()
+        while len(self.running) < self.concurrency and len(self.to_run) > 0:
+            self._dispatch(self.to_run.pop())
+        
+        # tasks whose result was already known finish without running
+        for task, result in self.shared_finished:
+            task.finished(result)
+            to_return.append(task)
+        self.shared_finished = []
         
         return to_return
+
+    def take_failed(self):
+        """Returns the tasks dropped after failing since the last call"""
+        failed = self.failed
+        self.failed = []
+        return failed
+
+    def describe_concurrency(self):
+        """Returns a short description of the pool's concurrency for logging"""
+        if self.controller is None:
+            return 'limit %d' % self.concurrency
+        return self.controller.describe()
+
+    def wait(self):
+        """Blocks until a running task has completed"""
+        wait_any([self])
+
+def wait_any(pools, woken=None):
+    """Blocks until one of the given pools, which must share a wakeup
+    condition, has a completed task, or until woken() is True for callers
+    that notify the condition themselves. Returns immediately if none of
+    the pools has anything running."""
+    wakeup = pools[0].wakeup
+    with wakeup:
+        # checked under the lock, so a completion can't slip in between the
+        # check and the wait
+        while not any(pool.has_completed() for pool in pools):
+            if woken is not None and woken():
+                return
+            if all(len(pool.running) == 0 for pool in pools):
+                return
+            # no timeout: with one, Python 2 polls the lock instead of blocking
+            wakeup.wait()
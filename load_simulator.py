@@ -0,0 +1,448 @@
+"""Offline discrete-event simulator for the load pipeline.
+
+Replays the Task graph load_scheduler builds for a scene from
+scene_generator.py, using only the scene's metadata and its table of hash
+sizes. Downloads share a link of fixed bandwidth after a fixed latency per
+request, loads take CPU time proportional to mesh size, and applying
+results on the main thread costs time too. No Panda3D or network is needed,
+so a policy variant takes a fraction of a second to evaluate.
+
+Visual completeness at a point in time is the fraction of each model's
+bytes that have been applied, weighted by the model's solid angle."""
+
+import sys
+import heapq
+import pickle
+import argparse
+import itertools
+from collections import namedtuple
+
+import load_scheduler
+import concurrency
+import open3dhub
+import scene
+import priority_policy
+
+BANDWIDTH = 1024 * 1024
+"""Bytes per second of the simulated link, shared by all transfers"""
+LATENCY = 0.05
+"""Seconds from issuing a request until its first byte arrives"""
+DOWNLOAD_CONCURRENCY = 4
+"""Number of download tasks run at once"""
+LOAD_CONCURRENCY = 2
+"""Number of load tasks run at once"""
+LOAD_FIXED_SECONDS = 0.05
+"""CPU seconds of every load task, besides its per-byte cost"""
+LOAD_SECONDS_PER_MB = 0.5
+"""CPU seconds to parse, flatten and write one MB of uncompressed mesh"""
+ATTACH_SECONDS = 0.01
+"""Main thread seconds to attach a loaded model to the scene"""
+APPLY_TEXTURE_SECONDS_PER_MB = 0.05
+"""Main thread seconds to decode and swap in one MB of texture"""
+APPLY_REFINEMENTS_SECONDS_PER_MB = 0.1
+"""Main thread seconds to apply one MB of progressive refinements"""
+CAMERA_POS = (0, 30000, 10000)
+"""Camera position of the simulated view, the scene viewer's starting one"""
+
+MB = 1024.0 * 1024.0
+
+class Params(object):
+    """Cost model of a simulation, defaulting to the module constants"""
+
+    def __init__(self, **kwargs):
+        self.bandwidth = kwargs.pop('bandwidth', BANDWIDTH)
+        self.latency = kwargs.pop('latency', LATENCY)
+        self.download_concurrency = kwargs.pop('download_concurrency', DOWNLOAD_CONCURRENCY)
+        self.load_concurrency = kwargs.pop('load_concurrency', LOAD_CONCURRENCY)
+        self.load_fixed_seconds = kwargs.pop('load_fixed_seconds', LOAD_FIXED_SECONDS)
+        self.load_seconds_per_mb = kwargs.pop('load_seconds_per_mb', LOAD_SECONDS_PER_MB)
+        self.attach_seconds = kwargs.pop('attach_seconds', ATTACH_SECONDS)
+        self.apply_texture_seconds_per_mb = kwargs.pop('apply_texture_seconds_per_mb', APPLY_TEXTURE_SECONDS_PER_MB)
+        self.apply_refinements_seconds_per_mb = kwargs.pop('apply_refinements_seconds_per_mb', APPLY_REFINEMENTS_SECONDS_PER_MB)
+        if kwargs:
+            raise TypeError('unknown parameters: %s' % ', '.join(sorted(kwargs)))
+
+SimulationResult = namedtuple('SimulationResult', ['curve', 'finish_time', 'mean_completeness', 'bytes_downloaded'])
+"""Outcome of a simulation. curve is a list of (seconds, completeness) at
+every change, and mean_completeness the average over the run."""
+
+class SimulatedDecoder(object):
+    """Stands in for open3dhub.PDAEStreamDecoder, finishing once the whole
+    progressive stream has been fed to it"""
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes_decoded = 0
+        self.refinements_read = 0
+        self.num_refinements = None
+        self.average_refinement_size = None
+        self.tail = ''
+
+    @property
+    def done(self):
+        return self.bytes_decoded >= self.size
+
+    def feed(self, length):
+        self.bytes_decoded += length
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+def prepare_models(models, model_type='progressive', model_subtype='base', camera_pos=CAMERA_POS):
+    """Sets up scene models the way the scene viewer does, with solid
+    angles for the view from camera_pos"""
+    locs, radii = scene.model_bounds(models)
+    angles = scene.solid_angles(camera_pos, locs, radii)
+    for model, angle in zip(models, angles):
+        model.model_type = model_type
+        model.model_subtype = model_subtype
+        model.solid_angle = float(angle)
+        model.screen_solid_angle = float(angle)
+    return models
+
+def _fetch_size(sizes, dlhash, httprange):
+    if httprange is None:
+        return sizes[dlhash]['gzip_size']
+    return httprange[1]
+
+class _ModelProgress(object):
+    """Bytes of a model that have been applied, out of its total"""
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.total = 0
+        self.applied = 0
+        self.texture_bytes = {}
+        self.texture_full_bytes = {}
+
+class Simulation(object):
+    """One run of a scene under a priority_policy.PriorityPolicy, by default
+    the active one"""
+
+    def __init__(self, models, sizes, params=None, policy=None):
+        self.models = models
+        self.sizes = sizes
+        self.params = params or Params()
+        self.policy = policy
+
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+
+        self.download_queue = load_scheduler.IndexedHeap()
+        self.load_queue = load_scheduler.IndexedHeap()
+        self.downloads_running = 0
+        self.loads_running = 0
+        self.parked_textures = load_scheduler.ParkedTextures()
+        # remaining bytes of each transfer on the link, keyed by task
+        self.transfers = {}
+        # (offset, end) ranges of each hash downloaded so far, standing in
+        # for the blob cache and the sharing of downloads between models
+        self.fetched = {}
+        self.bytes_downloaded = 0
+        self.main_thread_free = 0.0
+
+        self.progress = {}
+        self.total_weight = 0.0
+        self.completeness = 0.0
+        self.curve = [(0.0, 0.0)]
+
+    def _schedule(self, when, func, *args):
+        heapq.heappush(self.events, (when, next(self.seq), func, args))
+
+    def _add_model(self, model):
+        progress = _ModelProgress(model.solid_angle)
+        self.progress[id(model)] = progress
+        self.total_weight += progress.weight
+
+        plan = open3dhub.plan_model_download(model)
+        if plan is None:
+            return
+
+        progress.total = self._plan_bytes(plan)
+        for dlhash, httprange in [f for basename, f in plan.subfile_fetches]:
+            if httprange is not None:
+                progress.texture_bytes[dlhash] = httprange[1]
+        # each texture level replaces the one before it, so a texture adds
+        # the size of its largest level over its base level
+        for task in plan.dependents:
+            if isinstance(task, load_scheduler.TextureDownloadTask):
+                length = task.mipmap_levels[-1]['length']
+                progress.texture_full_bytes[task.tar_hash] = length
+                progress.total += max(0, length - progress.texture_bytes.get(task.tar_hash, 0))
+            elif isinstance(task, load_scheduler.ProgressiveDownloadTask):
+                progress.total += self.sizes[task.progressive_hash]['gzip_size']
+
+        task = load_scheduler.ModelDownloadTask(model, priority=priority_policy.get_policy().model_priority(model))
+        task.sim_plan = plan
+        self._enqueue(task)
+
+    def _plan_bytes(self, plan):
+        fetches = [(plan.mesh_hash, None)] + [f for basename, f in plan.subfile_fetches]
+        if plan.prog_fetch is not None:
+            fetches.append(plan.prog_fetch)
+        return sum(_fetch_size(self.sizes, dlhash, httprange) for dlhash, httprange in fetches)
+
+    def _enqueue(self, task):
+        # the simulated camera doesn't move, so parked textures stay parked
+        if self.parked_textures.park(task):
+            return
+        load_scheduler.rescale_priority(task)
+        if isinstance(task, load_scheduler.LoadTask):
+            self.load_queue.push(task)
+        else:
+            self.download_queue.push(task)
+
+    def _dispatch(self):
+        while self.downloads_running < self.params.download_concurrency and len(self.download_queue) > 0:
+            self.downloads_running += 1
+            self._start_download(self.download_queue.pop())
+        while self.loads_running < self.params.load_concurrency and len(self.load_queue) > 0:
+            self.loads_running += 1
+            task = self.load_queue.pop()
+            cost = self.params.load_fixed_seconds + self.params.load_seconds_per_mb * task.sim_mesh_size / MB
+            self._schedule(self.now + cost, self._load_done, task)
+
+    def _transfer(self, dlhash, httprange, fetch_length=None):
+        """Returns the bytes fetching a range of a hash transfers, which is
+        nothing if an earlier fetch covered it, and records the fetch"""
+        ranges = self.fetched.setdefault(dlhash, [])
+        if httprange is None:
+            offset, length = 0, float('inf')
+        else:
+            offset, length = httprange
+        for start, end in ranges:
+            if start <= offset and offset + length <= end:
+                return 0
+        if httprange is None:
+            ranges.append((0, float('inf')))
+            return self.sizes[dlhash]['gzip_size']
+        if fetch_length is None:
+            fetch_length = length
+        ranges.append((offset, offset + fetch_length))
+        return fetch_length
+
+    def _download_bytes(self, task):
+        """Returns the bytes a download task transfers, given what has been
+        fetched before"""
+        if isinstance(task, load_scheduler.ModelDownloadTask):
+            plan = task.sim_plan
+            fetches = [(plan.mesh_hash, None)] + [f for basename, f in plan.subfile_fetches]
+            if plan.prog_fetch is not None:
+                fetches.append(plan.prog_fetch)
+            return sum(self._transfer(dlhash, httprange) for dlhash, httprange in fetches)
+
+        if isinstance(task, load_scheduler.TextureDownloadTask):
+            return self._transfer(task.tar_hash, (task.offset, task.length), task.fetch_length)
+
+        if isinstance(task, load_scheduler.ProgressiveDownloadTask):
+            sizes = self.sizes[task.progressive_hash]
+            length = max(0, min(task.length, sizes['size'] - task.offset))
+            task.sim_stream_bytes = length
+            task.sim_bytes = int(length * float(sizes['gzip_size']) / sizes['size'])
+            if self._transfer(task.progressive_hash, (task.offset, length)) == 0:
+                return 0
+            return task.sim_bytes
+
+        raise ValueError('unknown task type %s' % type(task))
+
+    def _start_download(self, task):
+        num_bytes = self._download_bytes(task)
+        self.bytes_downloaded += num_bytes
+        if num_bytes == 0:
+            self._schedule(self.now, self._download_done, task)
+        else:
+            self._schedule(self.now + self.params.latency, self._start_transfer, task, num_bytes)
+
+    def _start_transfer(self, task, num_bytes):
+        self.transfers[task] = float(num_bytes)
+
+    def _advance_transfers(self, until):
+        if self.transfers and until > self.now:
+            sent = (until - self.now) * self.params.bandwidth / len(self.transfers)
+            for task in self.transfers:
+                self.transfers[task] -= sent
+        self.now = until
+
+    def _download_done(self, task):
+        self.downloads_running -= 1
+
+        if isinstance(task, load_scheduler.ModelDownloadTask):
+            plan = task.sim_plan
+            load_task = load_scheduler.LoadTask(None, {}, task.model, priority=priority_policy.get_policy().load_priority(task.model),
+                                                is_bam=plan.is_bam)
+            load_task.sim_mesh_size = self.sizes[plan.mesh_hash]['size']
+            load_task.sim_bytes = self._plan_bytes(plan)
+            for dependent in plan.dependents:
+                if isinstance(dependent, load_scheduler.ProgressiveDownloadTask):
+                    dependent.decoder = SimulatedDecoder(self.sizes[dependent.progressive_hash]['size'])
+            load_task.dependents.extend(plan.dependents)
+            task.finished([load_task])
+
+        elif isinstance(task, load_scheduler.TextureDownloadTask):
+            task.finished('')
+            self._apply(task.length * self.params.apply_texture_seconds_per_mb / MB, self._texture_applied, task)
+
+        elif isinstance(task, load_scheduler.ProgressiveDownloadTask):
+            task.decoder.feed(task.sim_stream_bytes)
+            task.finished((task.decoder, []))
+            self._apply(task.sim_stream_bytes * self.params.apply_refinements_seconds_per_mb / MB,
+                        self._credit, task.model, task.sim_bytes)
+
+        for dependent in task.dependents:
+            self._enqueue(dependent)
+
+    def _load_done(self, task):
+        self.loads_running -= 1
+        self._apply(self.params.attach_seconds, self._credit, task.model, task.sim_bytes)
+        for dependent in task.dependents:
+            self._enqueue(dependent)
+
+    def _apply(self, cost, func, *args):
+        """Runs func once the main thread has spent cost seconds on it,
+        after whatever it is already busy with"""
+        self.main_thread_free = max(self.now, self.main_thread_free) + cost
+        self._schedule(self.main_thread_free, func, *args)
+
+    def _texture_applied(self, task):
+        progress = self.progress[id(task.model)]
+        previous = progress.texture_bytes.get(task.tar_hash, 0)
+        length = task.length
+        if not any(isinstance(dependent, load_scheduler.TextureDownloadTask) and load_scheduler.texture_needed(dependent)
+                   for dependent in task.dependents):
+            # the last level downloaded is all the model's size on screen
+            # can show, so the texture counts as complete
+            length = progress.texture_full_bytes.get(task.tar_hash, length)
+        if length > previous:
+            progress.texture_bytes[task.tar_hash] = length
+            self._credit(task.model, length - previous)
+
+    def _credit(self, model, num_bytes):
+        progress = self.progress[id(model)]
+        if progress.total == 0 or self.total_weight == 0:
+            return
+        applied = min(progress.total, progress.applied + num_bytes)
+        self.completeness += progress.weight * (applied - progress.applied) / progress.total / self.total_weight
+        progress.applied = applied
+        self.curve.append((self.now, self.completeness))
+
+    def run(self):
+        """Runs the simulation to the end and returns a SimulationResult"""
+        stdout = sys.stdout
+        # tasks print as they go, which would dominate the run time
+        sys.stdout = _NullWriter()
+        active_policy = priority_policy.get_policy()
+        if self.policy is not None:
+            priority_policy.set_policy(self.policy)
+        # texture level choices see the simulated link as the measured one
+        measured_throughput = concurrency.THROUGHPUT.bytes_per_second
+        concurrency.THROUGHPUT.bytes_per_second = self.params.bandwidth
+        try:
+            for model in self.models:
+                self._add_model(model)
+            self._dispatch()
+
+            while self.events or self.transfers:
+                next_event = self.events[0][0] if self.events else float('inf')
+                if self.transfers:
+                    rate = self.params.bandwidth / len(self.transfers)
+                    next_transfer = self.now + min(self.transfers.itervalues()) / rate
+                    if next_transfer <= next_event:
+                        self._advance_transfers(next_transfer)
+                        for task in [task for task, remaining in self.transfers.iteritems() if remaining <= 1e-6]:
+                            del self.transfers[task]
+                            self._download_done(task)
+                        self._dispatch()
+                        continue
+
+                when, seq, func, args = heapq.heappop(self.events)
+                self._advance_transfers(when)
+                func(*args)
+                self._dispatch()
+        finally:
+            sys.stdout = stdout
+            priority_policy.set_policy(active_policy)
+            concurrency.THROUGHPUT.bytes_per_second = measured_throughput
+
+        return SimulationResult(curve=self.curve,
+                                finish_time=self.now,
+                                mean_completeness=mean_completeness(self.curve, self.now),
+                                bytes_downloaded=self.bytes_downloaded)
+
+def mean_completeness(curve, horizon):
+    """Returns the average of a completeness curve from 0 to horizon
+    seconds, holding its last value until the horizon"""
+    if horizon <= 0:
+        return curve[-1][1]
+    area = 0.0
+    for (t0, c0), (t1, c1) in zip(curve, curve[1:] + [(horizon, curve[-1][1])]):
+        t1 = min(t1, horizon)
+        if t1 > t0:
+            area += c0 * (t1 - t0)
+    return area / horizon
+
+def time_to(curve, completeness):
+    """Returns the first time curve reaches completeness, or None"""
+    for t, c in curve:
+        if c >= completeness - 1e-9:
+            return t
+    return None
+
+def simulate(models, sizes, params=None, policy=None):
+    """Runs one simulation of models, prepared with prepare_models, under
+    policy and returns its SimulationResult"""
+    open3dhub.HASH_SIZES = sizes
+    return Simulation(models, sizes, params, policy).run()
+
+def format_result(result, horizon=None):
+    if horizon is None:
+        horizon = result.finish_time
+    lines = ['finished after %.2f s, %.1f MB downloaded' % (result.finish_time, result.bytes_downloaded / MB),
+             'mean completeness over %.2f s: %.4f' % (horizon, mean_completeness(result.curve, horizon))]
+    for fraction in (0.5, 0.9, 0.99):
+        t = time_to(result.curve, fraction)
+        lines.append('%2d%% complete at %s' % (fraction * 100, 'never' if t is None else '%.2f s' % t))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate loading a scene file without Panda3D or the network')
+
+    parser.add_argument('scene_file', help='Scene file to use, generated with scene_generator', type=argparse.FileType('r'))
+    parser.add_argument('--model-type', choices=['progressive', 'optimized'], default='progressive', required=False, help='Model type to use')
+    parser.add_argument('--model-subtype', choices=['base', 'full'], default='base', required=False, help='Model subtype (currently only for progressive)')
+    parser.add_argument('--priority-policy', choices=sorted(priority_policy.POLICIES), default=None, required=False,
+                        help='How load tasks are prioritized (defaults to comparing all policies)')
+    parser.add_argument('--bandwidth', type=float, default=BANDWIDTH / 1024.0, help='Link bandwidth in KB/s')
+    parser.add_argument('--latency', type=float, default=LATENCY * 1000, help='Request latency in ms')
+    parser.add_argument('--download-concurrency', type=int, default=DOWNLOAD_CONCURRENCY, help='Number of download tasks run at once')
+    parser.add_argument('--load-concurrency', type=int, default=LOAD_CONCURRENCY, help='Number of load tasks run at once')
+    parser.add_argument('--load-seconds-per-mb', type=float, default=LOAD_SECONDS_PER_MB, help='CPU seconds to load one MB of mesh')
+    parser.add_argument('--horizon', type=float, required=False, help='Seconds to average completeness over (defaults to the finish time)')
+    parser.add_argument('--curve', action='store_true', default=False, help='Print the completeness curve')
+
+    args = parser.parse_args()
+
+    scene_dict = pickle.load(args.scene_file)
+    models = prepare_models(scene_dict['models'], args.model_type, args.model_subtype)
+    params = Params(bandwidth=args.bandwidth * 1024,
+                    latency=args.latency / 1000.0,
+                    download_concurrency=args.download_concurrency,
+                    load_concurrency=args.load_concurrency,
+                    load_seconds_per_mb=args.load_seconds_per_mb)
+
+    if args.priority_policy is None:
+        policy_names = sorted(priority_policy.POLICIES)
+    else:
+        policy_names = [args.priority_policy]
+
+    for name in policy_names:
+        result = simulate(models, scene_dict['sizes'], params, priority_policy.POLICIES[name]())
+        print '---', name, '---'
+        if args.curve:
+            for t, c in result.curve:
+                print '%.3f %.4f' % (t, c)
+        print format_result(result, args.horizon)
+
+if __name__ == '__main__':
+    main()
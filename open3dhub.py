@@ -1,22 +1,36 @@
 import json
 import posixpath
-from StringIO import StringIO
+from xml.parsers import expat
 import gzip
 import tempfile
-import math
 import os
-import requests
 import pickle
 import time
+import math
+from collections import namedtuple
 
 import numpy
-import collada
-from meshtool.filters.panda_filters import pandacore
-from meshtool.filters.panda_filters import pdae_utils
-from meshtool.filters.simplify_filters import add_back_pm
-from panda3d.core import GeomNode, NodePath, Mat4
+try:
+    import collada
+    from meshtool.filters.panda_filters import pandacore
+    from meshtool.filters.panda_filters import pdae_utils
+    from meshtool.filters.simplify_filters import add_back_pm
+    from panda3d.core import GeomNode, NodePath, Mat4
+    from panda3d.core import PNMImage, Texture, StringStream
+except ImportError:
+    # the metadata and task planning functions work without these, which
+    # is all load_simulator needs
+    collada = pandacore = pdae_utils = add_back_pm = None
+    GeomNode = NodePath = Mat4 = None
+    PNMImage = Texture = StringStream = None
 
 import load_scheduler
+import concurrency
+import fetcher
+import blob_cache
+import spool
+import tracing
+import priority_policy
 
 BASE_URL = 'http://open3dhub.com'
 # 'http://singular.stanford.edu'
@@ -26,12 +40,35 @@ DNS_URL = BASE_URL + '/dns'
 
 PANDA3D = False
 
+HASH_SIZES = None
+"""Sizes of the hashes in the current scene, set by the scene viewer"""
+
 PROGRESSIVE_CHUNK_SIZE = 2 * 1024 * 1024 # 2 MB
+PROGRESSIVE_MIN_CHUNK_SIZE = 64 * 1024 # 64 KB
+PROGRESSIVE_MAX_CHUNK_SIZE = 16 * 1024 * 1024 # 16 MB
+PROGRESSIVE_CHUNK_SECONDS = 2.0
+"""Seconds a chunk of a progressive stream should take to download at the
+measured throughput. Until there is a measurement, chunks are
+PROGRESSIVE_CHUNK_SIZE."""
+TEXTURE_COALESCE_SIZE = 256 * 1024 # 256 KB
+
+TEXTURE_LEVEL_SECONDS = 1.0
+"""Seconds a texture refinement should take to download at the measured
+throughput, which decides how many mipmap levels it skips"""
+SCREEN_PIXELS = 1920 * 1080
+"""Pixels on the screen"""
+VIEW_SOLID_ANGLE = 0.35
+"""Solid angle in steradians the screen covers"""
+TEXTURE_SCREEN_MARGIN = 4.0
+"""Texture pixels per pixel a model covers on screen past which further
+mipmap levels aren't downloaded"""
 
 CURDIR = os.path.dirname(__file__)
 TEMPDIR = os.path.join(CURDIR, '.temp_models')
 
-REQUESTS_SESSION = requests.session()
+HASH_SIZE_CACHE = os.path.join(CURDIR, 'hash-size-cache.pickle')
+HASH_SIZE_JOURNAL = os.path.join(CURDIR, 'hash-size-cache.journal')
+CATALOG_FILE = os.path.join(CURDIR, '.catalog')
 
 class PathInfo(object):
     """Helper class for dealing with CDN paths"""
@@ -66,20 +103,102 @@ class PathInfo(object):
 def urlfetch(url, httprange=None):
     """Fetches the given URL and returns data from it.
     Will take care of gzip if enabled on server."""
+    return fetcher.get_engine().fetch(url, httprange)
+
+IN_FLIGHT = fetcher.SingleFlight()
+"""Downloads in flight by (hash, httprange), so that models sharing a hash
+download it once"""
+
+def _fetch_and_cache(dlhash, httprange):
+    cache = blob_cache.get_cache()
+    # a download of the same hash may have just finished
+    data = cache.get(dlhash, httprange)
+    if data is None:
+        data = urlfetch(DOWNLOAD_URL + '/' + dlhash, httprange)
+        cache.put(dlhash, httprange, data)
+    return data
+
+def hashfetch(dlhash, httprange=None):
+    """Fetches the given hash and returns data from it.
+    Served from the on-disk blob cache when possible, and shared with
+    a download of the same hash and range already in flight."""
+    data = blob_cache.get_cache().get(dlhash, httprange)
+    if data is None:
+        data, leader = IN_FLIGHT.do((dlhash, httprange), _fetch_and_cache, dlhash, httprange)
+    return data
+
+def _hashfetch_all(hashes_and_ranges):
+    """Fetches a list of (hash, httprange) tuples concurrently as given,
+    going to the network only for blobs missing from the cache"""
+    cache = blob_cache.get_cache()
+    results = [cache.get(dlhash, httprange) for dlhash, httprange in hashes_and_ranges]
     
-    headers = {}
-    if httprange is not None:
-        offset, length = httprange
-        headers['Range'] = 'bytes=%d-%d' % (offset, offset+length-1)
+    engine = fetcher.get_engine()
+    misses = [i for i, data in enumerate(results) if data is None]
+    pending = []
+    for i in misses:
+        dlhash, httprange = hashes_and_ranges[i]
+        pending.append(engine.submit(IN_FLIGHT.do, (dlhash, httprange), _fetch_and_cache, dlhash, httprange))
     
-    resp = REQUESTS_SESSION.get(url, headers=headers)
+    for i, result in zip(misses, pending):
+        results[i], leader = result.get()
+    
+    return results
+
+def plan_hashfetch(hashes_and_ranges, max_gap=fetcher.COALESCE_GAP):
+    """Plans the requests needed for a list of (hash, httprange) tuples.
+    A full download of a hash covers all of its ranges, and nearby ranges
+    of the same hash are merged into one request.
     
-    return resp.content
+    Returns (requests, slices) where requests is a list of (hash, httprange)
+    tuples to fetch and slices has a (request index, start, length) tuple
+    for each input, with length None meaning the whole response."""
     
+    by_hash = {}
+    for i, (dlhash, httprange) in enumerate(hashes_and_ranges):
+        by_hash.setdefault(dlhash, []).append(i)
+    
+    requests = []
+    slices = [None] * len(hashes_and_ranges)
+    for dlhash, indices in by_hash.iteritems():
+        ranges = [hashes_and_ranges[i][1] for i in indices]
+        
+        if None in ranges:
+            requests.append((dlhash, None))
+            for i, httprange in zip(indices, ranges):
+                if httprange is None:
+                    slices[i] = (len(requests) - 1, 0, None)
+                else:
+                    slices[i] = (len(requests) - 1, httprange[0], httprange[1])
+            continue
+        
+        for merged, members in fetcher.coalesce_ranges(ranges, max_gap):
+            requests.append((dlhash, merged))
+            for member in members:
+                offset, length = ranges[member]
+                if (offset, length) == merged:
+                    slices[indices[member]] = (len(requests) - 1, 0, None)
+                else:
+                    slices[indices[member]] = (len(requests) - 1, offset - merged[0], length)
+    
+    return requests, slices
 
-def hashfetch(dlhash, httprange=None):
-    """Fetches the given hash and returns data from it."""
-    return urlfetch(DOWNLOAD_URL + '/' + dlhash, httprange)
+def hashfetch_ranges(hashes_and_ranges, max_gap=fetcher.COALESCE_GAP):
+    """Fetches a list of (hash, httprange) tuples with as few requests as
+    possible. Returns zero-copy buffer views into the fetched data, in the
+    same order as given."""
+    
+    requests, slices = plan_hashfetch(hashes_and_ranges, max_gap)
+    fetched = _hashfetch_all(requests)
+    
+    results = []
+    for request_index, start, length in slices:
+        data = fetched[request_index]
+        if length is None:
+            results.append(data)
+        else:
+            results.append(buffer(data, start, length))
+    return results
 
 def get_subfile_hash(subfile_path):
     subfile_url = DNS_URL + subfile_path
@@ -87,50 +206,113 @@ def get_subfile_hash(subfile_path):
     subfile_hash = subfile_json['Hash']
     return subfile_hash
 
-def get_list(limit=20):
-    """Returns a list of dictionaries containing model JSON"""
+def normalize_model_json(model_js):
+    """Rewrites the mipmap byte ranges of a model so they match the 512 byte
+    aligned layout of the tar file they point into"""
     
-    next_start = ''
-    all_items = []
-    unique_models = set()
+    progressive = model_js['metadata']['types'].get('progressive')
+    if progressive is not None and 'mipmaps' in progressive:
+        for mipmap_name, mipmap_data in progressive['mipmaps'].iteritems():
+            old_byte_ranges = mipmap_data['byte_ranges']
+            new_byte_ranges = []
+            offset = 0
+            for byte_data in old_byte_ranges:
+                offset += 512
+                new_byte_data = dict(byte_data)
+                if offset != new_byte_data['offset']:
+                    new_byte_data['offset'] = offset
+                file_len = new_byte_data['length']
+                file_len = 512 * ((file_len + 512 - 1) / 512)
+                offset += file_len
+                new_byte_ranges.append(new_byte_data)
+            mipmap_data['byte_ranges'] = new_byte_ranges
+    
+    return model_js
 
-    while len(all_items) < limit and next_start != None:
-        print 'got', len(all_items), 'so far'
-        
-        models_js = json.loads(urlfetch(BROWSE_URL + '/' + next_start))
+def iter_pages(start=''):
+    """Yields (page_start, next_start, content_items) for each page of the
+    browse API, beginning at the given cursor. The next page is requested
+    as soon as its cursor is known, while the caller works on this one."""
+    
+    engine = fetcher.get_engine()
+    pending = engine.fetch_async(BROWSE_URL + '/' + start)
+    page_start = start
+    
+    while pending is not None:
+        models_js = json.loads(pending.get())
         next_start = models_js['next_start']
         
-        models_js = models_js['content_items']
+        pending = None
+        if next_start is not None:
+            pending = engine.fetch_async(BROWSE_URL + '/' + next_start)
+        
+        yield page_start, next_start, models_js['content_items']
+        page_start = next_start
+
+def iter_list(limit=None, start=''):
+    """Yields normalized model JSON dictionaries as catalog pages arrive"""
+    
+    num_items = 0
+    unique_models = set()
+    
+    for page_start, next_start, models_js in iter_pages(start):
+        print 'got', num_items, 'so far'
         
         for model_js in models_js:
-            
-            progressive = model_js['metadata']['types'].get('progressive')
-            if progressive is not None and 'mipmaps' in progressive:
-                for mipmap_name, mipmap_data in progressive['mipmaps'].iteritems():
-                    old_byte_ranges = mipmap_data['byte_ranges']
-                    new_byte_ranges = []
-                    offset = 0
-                    for byte_data in old_byte_ranges:
-                        offset += 512
-                        new_byte_data = dict(byte_data)
-                        if offset != new_byte_data['offset']:
-                            new_byte_data['offset'] = offset
-                        file_len = new_byte_data['length']
-                        file_len = 512 * ((file_len + 512 - 1) / 512)
-                        offset += file_len
-                        new_byte_ranges.append(new_byte_data)
-                    model_js['metadata']['types']['progressive']['mipmaps'][mipmap_name]['byte_ranges'] = new_byte_ranges
-            
             if model_js['full_path'] in unique_models:
                 print 'OMG< FOUND A DUPLICATE', model_js['full_path']
-            else:
-                unique_models.add(model_js['full_path'])
-                all_items.append(model_js)
-        
-    if len(all_items) > limit:
-        all_items = all_items[0:limit]
+                continue
+            
+            unique_models.add(model_js['full_path'])
+            yield normalize_model_json(model_js)
+            
+            num_items += 1
+            if limit is not None and num_items >= limit:
+                return
+
+def get_list(limit=20):
+    """Returns a list of dictionaries containing model JSON"""
+    return list(iter_list(limit))
+
+def refresh_catalog(force=False):
+    """Returns all models in the catalog, persisted in CATALOG_FILE.
+    
+    An existing catalog is refreshed incrementally: the crawl resumes from
+    the last page seen, and only new or changed items are merged in. If
+    force is True, the whole catalog is crawled again."""
+    
+    catalog = {'items': {}, 'order': [], 'last_start': ''}
+    if not force and os.path.isfile(CATALOG_FILE):
+        catalog = pickle.load(open(CATALOG_FILE, 'rb'))
+    
+    items = catalog['items']
+    order = catalog['order']
+    resumed_from = catalog['last_start']
+    num_changed = 0
+    
+    for page_start, next_start, models_js in iter_pages(catalog['last_start']):
+        print 'catalog has', len(order), 'items,', num_changed, 'new or changed'
+        for model_js in models_js:
+            model_js = normalize_model_json(model_js)
+            full_path = model_js['full_path']
+            if full_path not in items:
+                order.append(full_path)
+            elif items[full_path] == model_js:
+                continue
+            items[full_path] = model_js
+            num_changed += 1
         
-    return all_items
+        # the last page is fetched again next time since it may have grown
+        catalog['last_start'] = page_start
+    
+    if num_changed > 0 or force or catalog['last_start'] != resumed_from:
+        tmp_file = CATALOG_FILE + '.tmp'
+        f = open(tmp_file, 'wb')
+        pickle.dump(catalog, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_file, CATALOG_FILE)
+    
+    return [items[full_path] for full_path in order]
 
 def get_hash_sizes(items):
 
@@ -157,57 +339,168 @@ def get_hash_sizes(items):
                 for mipmap_data in type_data['mipmaps'].itervalues():
                     unique_keys.add(mipmap_data['hash'])
     
-    cache_file = os.path.join(CURDIR, 'hash-size-cache.pickle')
-    hash_cache = {}
-    if os.path.isfile(cache_file):
-        hash_cache = pickle.load(open(cache_file, 'rb'))
-        
+    hash_cache = load_hash_size_cache()
+    
     hash_sizes = {}
+    to_probe = []
     for hash in unique_keys:
         if hash in hash_cache:
             hash_sizes[hash] = hash_cache[hash]
         else:
-            resp = REQUESTS_SESSION.get(DOWNLOAD_URL + '/' + hash)
-            hash_sizes[hash] = {'size': len(resp.content),
-                                'gzip_size': int(resp.headers['content-length'])}
-            hash_cache[hash] = hash_sizes[hash]
+            to_probe.append(hash)
+    
+    print 'Probing sizes of', len(to_probe), 'hashes'
+    journal = open(HASH_SIZE_JOURNAL, 'ab')
+    try:
+        # results are journaled as they arrive so an interrupted run
+        # keeps everything it has already probed
+        for hash, sizes in fetcher.get_engine().map_unordered(probe_hash_size, to_probe):
+            hash_sizes[hash] = sizes
+            hash_cache[hash] = sizes
+            pickle.dump((hash, sizes), journal, pickle.HIGHEST_PROTOCOL)
+            journal.flush()
+    finally:
+        journal.close()
     
-    pickle.dump(hash_cache, open(cache_file, 'wb'))
+    save_hash_size_cache(hash_cache)
     
     return hash_sizes
 
+def probe_hash_size(hash):
+    """Returns (hash, {'size': ..., 'gzip_size': ...}) for the given hash,
+    downloading the body only if the server can't report the sizes"""
+    url = DOWNLOAD_URL + '/' + hash
+    engine = fetcher.get_engine()
+    
+    sizes = engine.probe_size(url)
+    if sizes is not None:
+        size, gzip_size = sizes
+    else:
+        resp = engine.session.get(url, timeout=engine.timeout)
+        size = len(resp.content)
+        gzip_size = int(resp.headers['content-length'])
+    
+    return hash, {'size': size, 'gzip_size': gzip_size}
+
+def load_hash_size_cache():
+    """Loads the hash size cache, including any entries journaled by a
+    previous run that didn't finish"""
+    hash_cache = {}
+    if os.path.isfile(HASH_SIZE_CACHE):
+        hash_cache = pickle.load(open(HASH_SIZE_CACHE, 'rb'))
+    
+    if os.path.isfile(HASH_SIZE_JOURNAL):
+        journal = open(HASH_SIZE_JOURNAL, 'rb')
+        try:
+            while True:
+                hash, sizes = pickle.load(journal)
+                hash_cache[hash] = sizes
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            # end of journal, or a record cut off by an interrupted write
+            pass
+        finally:
+            journal.close()
+    
+    return hash_cache
+
+def save_hash_size_cache(hash_cache):
+    """Atomically writes the hash size cache and clears the journal"""
+    tmp_file = HASH_SIZE_CACHE + '.tmp'
+    f = open(tmp_file, 'wb')
+    pickle.dump(hash_cache, f)
+    f.close()
+    os.rename(tmp_file, HASH_SIZE_CACHE)
+    
+    if os.path.isfile(HASH_SIZE_JOURNAL):
+        os.remove(HASH_SIZE_JOURNAL)
+
 def load_mesh(mesh_data, subfiles):
-    """Given a downloaded mesh, return a collada instance"""
+    """Given a downloaded mesh, return a collada instance. The mesh and
+    subfiles can be strings or spool.Payload handles."""
     
     def inline_loader(filename):
-        return subfiles[posixpath.basename(filename)]
-    
-    mesh = collada.Collada(StringIO(mesh_data), aux_file_loader=inline_loader)
+        return spool.read(subfiles[posixpath.basename(filename)])
     
-    #this will force loading of the textures too
-    for img in mesh.images:
-        img.data
+    with tracing.span('parse collada'):
+        mesh = collada.Collada(spool.open_data(mesh_data), aux_file_loader=inline_loader)
+        
+        #this will force loading of the textures too
+        for img in mesh.images:
+            img.data
     
     return mesh
 
-def download_mesh_and_subtasks(model):
-    """Given a model, downloads the mesh and returns a set of subtasks."""
+def model_download_size(model):
+    """Returns the number of bytes a ModelDownloadTask for model downloads"""
+    
+    type_dict = model.model_json['metadata']['types'][model.model_type]
+    
+    if PANDA3D:
+        panda3d_key = 'panda3d_%s_bam' % model.model_subtype if model.model_type == 'progressive' else 'panda3d_bam'
+        return HASH_SIZES[type_dict[panda3d_key]]['gzip_size']
+    
+    download_size = HASH_SIZES[type_dict['hash']]['gzip_size']
+    
+    if model.model_type == 'progressive':
+        
+        if model.model_subtype == 'base':
+            
+            for subfile in type_dict['subfiles']:
+                splitpath = subfile.split('/')
+                basename = './' + splitpath[-2]
+                
+                mipmap_levels = type_dict['mipmaps'][basename]['byte_ranges']
+                length = 0
+                for mipmap in mipmap_levels:
+                    length = mipmap['length']
+                    if mipmap['width'] >= 128 or mipmap['height'] >= 128:
+                        break
+                
+                download_size += length
+        
+        elif model.model_subtype == 'full':
+            
+            prog_hash = type_dict.get('progressive_stream')
+            if prog_hash is not None:
+                download_size += HASH_SIZES[prog_hash]['gzip_size']
+            
+            for subfile in type_dict['subfiles']:
+                splitpath = subfile.split('/')
+                basename = './' + splitpath[-2]
+                
+                mipmap_levels = type_dict['mipmaps'][basename]['byte_ranges']
+                if mipmap_levels:
+                    download_size += mipmap_levels[-1]['length']
+        
+        else:
+            raise Exception("unknown model subtype")
+    
+    else:
+        for subfile_hash in type_dict['subfile_hashes']:
+            download_size += HASH_SIZES[subfile_hash]['gzip_size']
+    
+    return download_size
+
+DownloadPlan = namedtuple('DownloadPlan', ['model_type', 'mesh_hash', 'is_bam', 'subfile_fetches', 'prog_fetch', 'dependents'])
+"""What download_mesh_and_subtasks fetches for a model and the tasks that
+follow its LoadTask. subfile_fetches is a list of (subfile basename, (hash,
+httprange)) and prog_fetch a (hash, httprange) or None."""
+
+def plan_model_download(model):
+    """Works out from a model's metadata alone what has to be downloaded
+    for it and which texture and progressive tasks come after it is
+    loaded. Returns a DownloadPlan, or None if the model doesn't have its
+    type."""
     
     types = model.model_json['metadata']['types']
-    model_type = model.model_type
-    if model_type == 'optimized_unflattened':
-        model_type = 'optimized'
-    elif model_type == 'progressive_full':
-        model_type = 'progressive'
+    model_type = load_scheduler.BASE_MODEL_TYPES.get(model.model_type, model.model_type)
     
     if not model_type in types:
         return None
     
     type_dict = types[model_type]
     
-    mipmaps = type_dict.get('mipmaps')
-    if mipmaps:
-        mipmaps = dict((posixpath.basename(p), info) for p, info in mipmaps.iteritems())
+    mipmaps = mipmaps_by_name(type_dict)
     
     mesh_hash = type_dict['hash']
     
@@ -216,37 +509,39 @@ def download_mesh_and_subtasks(model):
     if PANDA3D and panda3d_key in type_dict:
         bam_hash = type_dict[panda3d_key]
         print 'Downloading mesh (from bamfile)', model.model_json['base_path'], bam_hash
-        data = hashfetch(bam_hash)
+        mesh_download_hash = bam_hash
         is_bam = True
     else:
         print 'Downloading mesh', model.model_json['base_path'], mesh_hash
-        data = hashfetch(mesh_hash)
+        mesh_download_hash = mesh_hash
     
     subfile_basenames = [PathInfo(s).basepath for s in type_dict['subfiles']]
     subfile_name_hash_map = dict(zip(subfile_basenames, type_dict['subfile_hashes']))
     
-    subfile_dict = {}
+    # (subfile basename, (hash, httprange)) for everything that has to be
+    # downloaded, fetched all at once below
+    subfile_fetches = []
     
-    texture_task_base = None
+    texture_tasks = []
+    policy = priority_policy.get_policy()
     
     progressive_hash = type_dict.get('progressive_stream')
     progressive_task = None
     if progressive_hash is not None and model.model_subtype != 'full':
-        # priority is the solid angle
-        priority = model.solid_angle
-        # multiplied by a scale factor that makes earlier chunks have more weight
-        percentage = float(0 + PROGRESSIVE_CHUNK_SIZE) / model.HASH_SIZES[progressive_hash]['size']
-        priority = priority * ((1.0 - percentage) ** 2)
-        # divided by the gzip size
-        priority = priority / model.HASH_SIZES[progressive_hash]['gzip_size']
+        decoder = PDAEStreamDecoder()
+        chunk_size = progressive_chunk_size(progressive_hash, 0, decoder)
+        priority = policy.progressive_priority(model, progressive_hash, 0, chunk_size)
         
         progressive_task = load_scheduler.ProgressiveDownloadTask(model,
                                                                   0,
-                                                                  PROGRESSIVE_CHUNK_SIZE,
+                                                                  chunk_size,
                                                                   priority = priority,
-                                                                  refinements_read = 0,
-                                                                  num_refinements = None,
-                                                                  previous_data = '')
+                                                                  decoder = decoder)
+    
+    prog_fetch = None
+    if progressive_hash is not None and model.model_subtype == 'full':
+        print 'DOWNLOADING PROGRESSIVE STREAM'
+        prog_fetch = (progressive_hash, None)
     
     for subfile in type_dict['subfiles']:
         splitpath = subfile.split('/')
@@ -256,117 +551,421 @@ def download_mesh_and_subtasks(model):
             mipmap_levels = mipmaps[basename]['byte_ranges']
             tar_hash = mipmaps[basename]['hash']
             
-            base_pixels = 0
-            offset = 0
-            length = 0
-            for mipmap in mipmap_levels:
-                offset = mipmap['offset']
-                length = mipmap['length']
-                base_pixels = mipmap['width'] * mipmap['height']
-                if mipmap['width'] >= 128 or mipmap['height'] >= 128:
-                    break
+            base_mipmap = mipmap_levels[base_mipmap_level(mipmap_levels)]
+            offset = base_mipmap['offset']
+            length = base_mipmap['length']
+            base_pixels = base_mipmap['width'] * base_mipmap['height']
 
             if not is_bam:
                 print 'GETTING TEXTURE', subfile, 'AT RANGE', offset, length
-                texture_data = hashfetch(tar_hash, httprange=(offset, length))
-                subfile_dict[basename] = texture_data
+                subfile_fetches.append((basename, (tar_hash, (offset, length))))
             
-            for mipmap in reversed(mipmap_levels):
-                mipmap_pixels = mipmap['width'] * mipmap['height']
-                if mipmap_pixels <= base_pixels:
-                    break
-
-                # priority is the solid angle
-                priority = model.solid_angle
-                # multiplied by a factor to make smaller textures higher priority over larger
-                priority = priority * math.sqrt(float(base_pixels) / mipmap_pixels)
-                # multiplied by how big this tar range is relative to the total size
-                priority = priority * (float(mipmap['length']) / model.HASH_SIZES[tar_hash]['size'])
-                # divided by the gzip size
-                priority = priority / model.HASH_SIZES[tar_hash]['gzip_size']
-                
-                tex_dt = load_scheduler.TextureDownloadTask(model, mipmap['offset'], priority=priority)
-                if texture_task_base is not None:
-                    tex_dt.dependents.append(texture_task_base)
-                texture_task_base = tex_dt
+            # each texture refines on its own, and each finished level
+            # queues the one after it
+            texture_task = texture_download_task(model, tar_hash, basename, mipmap_levels, base_pixels)
+            if texture_task is not None:
+                texture_tasks.append(texture_task)
         
         elif mipmaps is not None and basename in mipmaps and model.model_subtype == 'full':
             mipmap_levels = mipmaps[basename]['byte_ranges']
             tar_hash = mipmaps[basename]['hash']
-
-            model.prog_data = None
-            if progressive_hash is not None:
-                print 'DOWNLOADING PROGRESSIVE STREAM'
-                prog_data = hashfetch(progressive_hash)
-                model.prog_data = prog_data
             
             full_texture = list(reversed(mipmap_levels))[0]
             
-            texture_basepath = PathInfo(subfile).basepath
             print 'DOWNLOADING HIGHEST TEXTURE SIZE'
-            texture_data = hashfetch(tar_hash, httprange=(full_texture['offset'], full_texture['length']))
-            subfile_dict[basename] = texture_data
+            subfile_fetches.append((basename, (tar_hash, (full_texture['offset'], full_texture['length']))))
         
         elif model.model_subtype != 'full':
             #texture_path = posixpath.normpath(posixpath.join(model.model_json['base_path'], model_type, model.model_json['version_num'], basename))
             #texture_hash = get_subfile_hash(texture_path)
             texture_basepath = PathInfo(subfile).basepath
             texture_hash = subfile_name_hash_map[texture_basepath]
-            texture_data = hashfetch(texture_hash)
-    
-            subfile_dict[basename] = texture_data
+            subfile_fetches.append((basename, (texture_hash, None)))
     
-    load_task = load_scheduler.LoadTask(data, subfile_dict, model, priority=model.solid_angle, is_bam=is_bam)
-    if texture_task_base is not None:
-        load_task.dependents.append(texture_task_base)
+    dependents = list(texture_tasks)
     if progressive_task is not None:
-        load_task.dependents.append(progressive_task)
+        dependents.append(progressive_task)
+    
+    return DownloadPlan(model_type=model_type,
+                        mesh_hash=mesh_download_hash,
+                        is_bam=is_bam,
+                        subfile_fetches=subfile_fetches,
+                        prog_fetch=prog_fetch,
+                        dependents=dependents)
+
+def download_mesh_and_subtasks(model):
+    """Given a model, downloads the mesh and returns a set of subtasks."""
+    
+    plan = plan_model_download(model)
+    if plan is None:
+        return None
+    
+    model_type = plan.model_type
+    is_bam = plan.is_bam
+    subfile_fetches = plan.subfile_fetches
+    prog_fetch = plan.prog_fetch
+    
+    engine = fetcher.get_engine()
+    
+    # images the mesh references that aren't in the subfile list are
+    # looked up and fetched as soon as the streaming parse sees them
+    requested_basenames = set(basename for basename, f in subfile_fetches)
+    unlisted_images = {}
+    def found_image(path):
+        basename = posixpath.basename(path)
+        if basename in requested_basenames or basename in unlisted_images:
+            return
+        print 'FOUND UNLISTED IMAGE', basename
+        subfile_path = posixpath.normpath(posixpath.join(model.model_json['base_path'], model_type, model.model_json['version_num'], basename))
+        unlisted_images[basename] = engine.submit(fetch_subfile, subfile_path)
+    
+    # the mesh is streamed on a fetch thread while the progressive stream
+    # and every subfile are requested concurrently from this one
+    mesh_job = engine.submit(download_mesh, plan.mesh_hash, None if is_bam else found_image)
+    
+    fetches = [f for basename, f in subfile_fetches]
+    if prog_fetch is not None:
+        fetches.append(prog_fetch)
+    # the buffers are only written to the spool file, which takes them as
+    # they are, so the coalesced responses are never copied
+    fetched = hashfetch_ranges(fetches)
+    
+    subfile_dict = dict(zip([basename for basename, f in subfile_fetches],
+                            fetched[:len(subfile_fetches)]))
+    prog_data = fetched[-1] if prog_fetch is not None else None
+    
+    data = mesh_job.get()
+    for basename, image_job in unlisted_images.iteritems():
+        subfile_dict[basename] = image_job.get()
+    
+    # everything is written once to a spool file, so only small handles
+    # are pickled on the way through the LoadingThread to the loader pool
+    basenames = subfile_dict.keys()
+    datas = [data] + [subfile_dict[basename] for basename in basenames]
+    if prog_data is not None:
+        datas.append(prog_data)
+    payloads = spool.write_payloads(datas)
+    
+    data = payloads[0]
+    subfile_dict = dict(zip(basenames, payloads[1:1 + len(basenames)]))
+    if prog_data is not None:
+        prog_data = payloads[-1]
+    
+    load_task = load_scheduler.LoadTask(data, subfile_dict, model, priority=priority_policy.get_policy().load_priority(model), is_bam=is_bam, prog_data=prog_data)
+    load_task.dependents.extend(plan.dependents)
     return [load_task]
 
-def download_texture(model, download_offset):
-    """Given a model and texture offset, downloads the texture"""
+class ImageReferenceScanner(object):
+    """Incrementally parses COLLADA data as it is downloaded, calling
+    found_image with the path of each <image> as soon as its <init_from>
+    has been read. Malformed documents are left for pycollada to report."""
     
-    types = model.model_json['metadata']['types']
-    type_dict = types[model.model_type]
+    def __init__(self, found_image):
+        self.found_image = found_image
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self._start_element
+        self.parser.EndElementHandler = self._end_element
+        self.parser.CharacterDataHandler = self._char_data
+        self.elements = []
+        self.init_from = None
+        self.failed = False
+    
+    def feed(self, data):
+        """Parses the next chunk of the document"""
+        if self.failed:
+            return
+        try:
+            self.parser.Parse(data, False)
+        except expat.ExpatError:
+            self.failed = True
+    
+    def _start_element(self, name, attrs):
+        name = name.split(':')[-1]
+        self.elements.append(name)
+        if name == 'init_from' and 'image' in self.elements:
+            self.init_from = []
+    
+    def _end_element(self, name):
+        name = self.elements.pop()
+        if name == 'init_from' and self.init_from is not None:
+            path = ''.join(self.init_from).strip()
+            self.init_from = None
+            if path:
+                self.found_image(path)
+    
+    def _char_data(self, data):
+        if self.init_from is not None:
+            self.init_from.append(data)
+
+def download_mesh(dlhash, found_image=None):
+    """Downloads a mesh, streaming it through an ImageReferenceScanner
+    if found_image is given so referenced images are known before the
+    download finishes"""
+    
+    cache = blob_cache.get_cache()
+    data = cache.get(dlhash)
+    if data is not None:
+        if found_image is not None:
+            ImageReferenceScanner(found_image).feed(data)
+        return data
+    
+    scanner = None
+    if found_image is not None:
+        scanner = ImageReferenceScanner(found_image)
+    
+    data, leader = IN_FLIGHT.do((dlhash, None), _stream_mesh, dlhash, scanner)
+    if not leader and scanner is not None:
+        # another model's download of this mesh did the streaming
+        scanner.feed(data)
+    return data
+
+def _stream_mesh(dlhash, scanner):
+    cache = blob_cache.get_cache()
+    data = cache.get(dlhash)
+    if data is not None:
+        if scanner is not None:
+            scanner.feed(data)
+        return data
+    
+    chunks = []
+    for chunk in fetcher.get_engine().stream(DOWNLOAD_URL + '/' + dlhash):
+        chunks.append(chunk)
+        if scanner is not None:
+            scanner.feed(chunk)
     
+    data = ''.join(chunks)
+    cache.put(dlhash, None, data)
+    return data
+
+def fetch_subfile(subfile_path):
+    """Looks up the hash of the subfile at the given CDN path and downloads it"""
+    return hashfetch(get_subfile_hash(subfile_path))
+
+def texture_fetch_length(mipmap_levels, level):
+    """Returns how many bytes to fetch for the given mipmap level. The
+    following levels sit right after it in the tar, so small ones are
+    fetched in the same request and land in the blob cache for the
+    TextureDownloadTasks that come next. Without a cache to keep them they
+    would be downloaded twice, so only the level itself is fetched."""
+    
+    offset = mipmap_levels[level]['offset']
+    end = offset + mipmap_levels[level]['length']
+    if blob_cache.get_cache().max_bytes <= 0:
+        return end - offset
+    for next_mipmap in mipmap_levels[level + 1:]:
+        next_end = next_mipmap['offset'] + next_mipmap['length']
+        if next_mipmap['offset'] - end > fetcher.COALESCE_GAP or next_end - offset > TEXTURE_COALESCE_SIZE:
+            break
+        end = next_end
+    return end - offset
+
+def mipmaps_by_name(type_dict):
+    """Returns the mipmap metadata of a model type keyed by the basename of
+    each texture, or None if it has none"""
     mipmaps = type_dict.get('mipmaps')
     if mipmaps:
         mipmaps = dict((posixpath.basename(p), info) for p, info in mipmaps.iteritems())
+    return mipmaps
+
+def base_mipmap_level(mipmap_levels):
+    """Returns the index of the mipmap level downloaded with the model, the
+    first one at least 128 pixels wide or high"""
+    for level, mipmap in enumerate(mipmap_levels):
+        if mipmap['width'] >= 128 or mipmap['height'] >= 128:
+            return level
+    return len(mipmap_levels) - 1
+
+def screen_pixels(model):
+    """Returns the number of texture pixels worth showing on a model at its
+    current size on screen, or None if its size on screen isn't known"""
+    if model.screen_solid_angle is None:
+        return None
+    return model.screen_solid_angle / VIEW_SOLID_ANGLE * SCREEN_PIXELS * TEXTURE_SCREEN_MARGIN
+
+def texture_covers_screen(model, shown_pixels):
+    """Returns True if a texture of shown_pixels pixels is already as
+    detailed as the model needs at its current size on screen"""
+    needed = screen_pixels(model)
+    return needed is not None and shown_pixels >= needed
+
+def next_texture_level(model, mipmap_levels, shown_pixels):
+    """Returns the index of the mipmap level to download after the one of
+    shown_pixels pixels, or None if there is no larger level.
     
-    assert(len(mipmaps) == 1)
-    basename = next(mipmaps.iterkeys())
+    This is the largest level that downloads within TEXTURE_LEVEL_SECONDS
+    at the measured throughput, so fast links skip the levels in between,
+    but no larger than the first level that covers the model on screen.
+    When the model is already covered that is the next level up, which
+    waits in load_scheduler.ParkedTextures until the model grows."""
     
-    mipmap_levels = mipmaps[basename]['byte_ranges']
-    tar_hash = mipmaps[basename]['hash']
+    pixels = [mipmap['width'] * mipmap['height'] for mipmap in mipmap_levels]
+    candidates = [level for level in range(len(mipmap_levels)) if pixels[level] > shown_pixels]
     
-    for mipmap in mipmap_levels:
-        offset = mipmap['offset']
-        length = mipmap['length']
+    needed = screen_pixels(model)
+    if needed is not None:
+        useful = [level for level in candidates if pixels[level] < needed]
+        candidates = useful + [level for level in candidates if pixels[level] >= needed][:1]
+    
+    if len(candidates) == 0:
+        return None
+    
+    throughput = concurrency.get_throughput()
+    if throughput is None:
+        # nothing has been measured yet, so go up one level at a time
+        return candidates[0]
+    
+    budget = throughput * TEXTURE_LEVEL_SECONDS
+    fitting = [level for level in candidates if mipmap_levels[level]['length'] <= budget]
+    if len(fitting) == 0:
+        return candidates[0]
+    return fitting[-1]
+
+def texture_download_task(model, tar_hash, texture_name, mipmap_levels, shown_pixels):
+    """Returns the TextureDownloadTask for the level of texture_name that
+    next_texture_level picks, or None"""
+    
+    level = next_texture_level(model, mipmap_levels, shown_pixels)
+    if level is None:
+        return None
+    base_mipmap = mipmap_levels[base_mipmap_level(mipmap_levels)]
+    base_pixels = base_mipmap['width'] * base_mipmap['height']
+    priority = priority_policy.get_policy().texture_priority(model, tar_hash, mipmap_levels, level, base_pixels,
+                                                             shown_pixels)
+    return load_scheduler.TextureDownloadTask(model, tar_hash, texture_name, mipmap_levels, level,
+                                              shown_pixels=shown_pixels,
+                                              fetch_length=texture_fetch_length(mipmap_levels, level),
+                                              priority=priority)
+
+def download_texture(tar_hash, offset, length, fetch_length=None):
+    """Downloads the texture at offset and length in the given mipmap tar,
+    fetching fetch_length bytes from offset if given"""
+    
+    if fetch_length is None:
+        fetch_length = length
+    texture_data = hashfetch(tar_hash, httprange=(offset, fetch_length))
+    return texture_data[:length]
+
+def decode_texture(data, texture_name):
+    """Decodes downloaded texture data into a Texture named texture_name,
+    with its mipmap levels generated in RAM, so that the main thread only
+    has to swap it in"""
+    
+    with tracing.span('decode texture'):
+        texpnm = PNMImage()
+        texpnm.read(StringStream(data), 'something.jpg')
+        texture = Texture(texture_name)
+        texture.load(texpnm)
+        texture.setMinfilter(Texture.FTLinearMipmapLinear)
+        texture.generateRamMipmapImages()
+    return texture
+
+class PDAEStreamDecoder(object):
+    """Incremental decoder for a progressive (PDAE) stream.
+    
+    Bytes are fed in as they are downloaded and only the newly completed
+    refinements are returned. Between chunks the decoder holds just its
+    parse position and the unconsumed tail of a partial refinement, so it
+    is cheap to pickle along with a ProgressiveDownloadTask."""
+    
+    def __init__(self):
+        self.refinements_read = 0
+        self.num_refinements = None
+        self.tail = ''
+        self.bytes_decoded = 0
+        """Number of stream bytes that ended up in complete refinements"""
+    
+    @property
+    def done(self):
+        """True once every refinement in the stream has been decoded"""
+        return self.num_refinements is not None and self.refinements_read >= self.num_refinements
+    
+    @property
+    def average_refinement_size(self):
+        """Average stream bytes per refinement decoded so far, or None
+        before the first one"""
+        if self.refinements_read == 0:
+            return None
+        return self.bytes_decoded / float(self.refinements_read)
+    
+    def feed(self, data):
+        """Decodes newly downloaded data, returning the refinements it completed"""
+        if self.tail:
+            data = self.tail + data
         
-        if offset == download_offset:
-            texture_data = hashfetch(tar_hash, httprange=(offset, length))
-            return texture_data
+        refinements_read, num_refinements, refinements, tail = \
+            pdae_utils.readPDAEPartial(data, self.refinements_read, self.num_refinements)
+        
+        self.bytes_decoded += len(data) - len(tail)
+        self.refinements_read = refinements_read
+        self.num_refinements = num_refinements
+        self.tail = tail
+        
+        return refinements
+    
+    def __str__(self):
+        return '<PDAEStreamDecoder refinements_read=%s, num_refinements=%s, tail=%d bytes>' % \
+                (self.refinements_read, self.num_refinements, len(self.tail))
+    def __repr__(self):
+        return str(self)
 
-def download_progressive(model, offset, length, refinements_read, num_refinements, previous_data):
-    """Given a model, offset and length, download progressive hash data"""
+def progressive_chunk_size(progressive_hash, offset, decoder):
+    """Returns how many bytes of a progressive stream to download from
+    offset in the next chunk. The chunk takes about PROGRESSIVE_CHUNK_SECONDS
+    at the measured throughput, and ends where the decoder expects a
+    refinement to end, from the average size of those it has read."""
     
-    types = model.model_json['metadata']['types']
-    type_dict = types[model.model_type]
-    progressive_hash = type_dict['progressive_stream']
+    sizes = HASH_SIZES[progressive_hash] if HASH_SIZES is not None else None
+    
+    throughput = concurrency.get_throughput()
+    if throughput is None:
+        length = PROGRESSIVE_CHUNK_SIZE
+    else:
+        # fetches count the decoded bytes they return, so the throughput
+        # is already in stream bytes
+        length = throughput * PROGRESSIVE_CHUNK_SECONDS
+        length = max(PROGRESSIVE_MIN_CHUNK_SIZE, min(PROGRESSIVE_MAX_CHUNK_SIZE, int(length)))
+    
+    refinement_size = decoder.average_refinement_size
+    if refinement_size is not None and refinement_size > 0:
+        # the tail of a partial refinement is decoded with this chunk
+        pending = len(decoder.tail)
+        refinements = max(1, int(math.ceil((pending + length) / refinement_size)))
+        length = max(1, int(refinements * refinement_size) - pending)
+    
+    if sizes is not None:
+        # don't ask for more than is left, or leave a sliver of the stream
+        # for a chunk of its own
+        remaining = sizes['size'] - offset
+        if remaining - length < PROGRESSIVE_MIN_CHUNK_SIZE:
+            length = max(1, remaining)
+    
+    return length
 
+def download_progressive(progressive_hash, offset, length, decoder):
+    """Given a progressive stream hash, offset and length, download progressive
+    hash data and feed it to decoder. Returns the decoder and the new refinements."""
+    
     data = hashfetch(progressive_hash, httprange=(offset, length))
+    refinements = decoder.feed(data)
     
-    if previous_data is not None:
-        data = previous_data + data
+    return decoder, refinements
 
-    refinements = pdae_utils.readPDAEPartial(data, refinements_read, num_refinements)
-    
-    return refinements
+def name_textures(nodepath, mesh):
+    """Names each texture under nodepath after the basename of the collada
+    image it was made from, which is the name its mipmaps and texture
+    refinements go by. pandacore names the textures it creates after the
+    id of their image."""
     
+    image_names = dict((image.id, posixpath.basename(image.path)) for image in mesh.images)
+    for tex in nodepath.findAllTextures():
+        name = image_names.get(tex.getName())
+        if name is not None:
+            tex.setName(name)
 
-def load_into_bamfile(meshdata, subfiles, model):
+def load_into_bamfile(meshdata, subfiles, model, prog_data=None):
     """Uses pycollada and panda3d to load meshdata and subfiles and
-    write out to a bam file on disk"""
+    write out to a bam file on disk. prog_data is the progressive stream
+    for full progressive models."""
 
     if os.path.isfile(model.bam_file):
         print 'returning cached bam file'
@@ -379,9 +978,9 @@ def load_into_bamfile(meshdata, subfiles, model):
         progressive_stream = model.model_json['metadata']['types']['progressive'].get('progressive_stream')
         if progressive_stream is not None:
             print 'LOADING PROGRESSIVE STREAM'
-            data = model.prog_data
             try:
-                mesh = add_back_pm.add_back_pm(mesh, StringIO(data), 100)
+                with tracing.span('add back pm'):
+                    mesh = add_back_pm.add_back_pm(mesh, spool.open_data(prog_data), 100)
                 print '-----'
                 print 'SUCCESSFULLY ADDED BACK PM'
                 print '-----'
@@ -412,12 +1011,15 @@ def load_into_bamfile(meshdata, subfiles, model):
             node.setGeomState(0, renderstate)
         geomPath = rotatePath.attachNewNode(node)
         geomPath.setMat(mat4)
+    
+    name_textures(rotatePath, mesh)
         
     print 'created np', model_name, mesh
 
     if model.model_type != 'optimized_unflattened' and model.model_type != 'progressive':
         print 'ABOUT TO FLATTEN'
-        rotatePath.flattenStrong()
+        with tracing.span('flattenStrong'):
+            rotatePath.flattenStrong()
         print 'DONE FLATTENING'
         
     print 'flattened', model_name, mesh
@@ -425,7 +1027,8 @@ def load_into_bamfile(meshdata, subfiles, model):
     wrappedNode = pandacore.centerAndScale(rotatePath)
     wrappedNode.setName(model_name)
 
-    wrappedNode.writeBamFile(model.bam_file)
+    with tracing.span('write bam'):
+        wrappedNode.writeBamFile(model.bam_file)
     print 'saved', model_name, mesh
     wrappedNode = None
     
@@ -0,0 +1,108 @@
+"""Predictive prefetching from camera motion.
+
+The camera's velocity and turn rate are extrapolated a few seconds ahead,
+and models are put in one of three tiers: in the current view frustum, in
+the frustum of one of the predicted views, or in neither. A model's solid
+angle is scaled by its tier's weight before tasks are rescored, so models
+about to come into view download ahead of hidden ones but behind what is
+already on screen."""
+
+import time
+import math
+
+import numpy
+
+PREDICT_SECONDS = 3.0
+"""How far ahead the camera's motion is extrapolated"""
+PREDICT_STEPS = 6
+"""Number of predicted views checked over PREDICT_SECONDS"""
+VELOCITY_SMOOTHING = 0.5
+"""Weight of the newest sample in the camera velocity estimate"""
+VISIBLE_WEIGHT = 1.0
+"""Solid angle weight of models in the current view"""
+PREDICTED_WEIGHT = 1e-3
+"""Solid angle weight of models only in a predicted view"""
+HIDDEN_WEIGHT = 1e-6
+"""Solid angle weight of models in neither"""
+
+def _normalize(v):
+    length = numpy.sqrt((v * v).sum())
+    if length == 0:
+        return v
+    return v / length
+
+class CameraPredictor(object):
+    """Estimates where the camera will be looking from the positions and
+    headings it is given over time"""
+
+    def __init__(self, smoothing=VELOCITY_SMOOTHING):
+        self.smoothing = smoothing
+        self.pos = None
+        self.heading = None
+        self.when = None
+        self.velocity = numpy.zeros(3)
+        self.turn_rate = numpy.zeros(3)
+
+    def update(self, pos, heading, when=None):
+        """Records the camera at pos looking along the heading vector"""
+        if when is None:
+            when = time.time()
+        pos = numpy.array(pos, dtype=numpy.float64)
+        heading = _normalize(numpy.array(heading, dtype=numpy.float64))
+
+        if self.pos is not None and (pos == self.pos).all() and (heading == self.heading).all():
+            # the camera has stopped
+            self.velocity = numpy.zeros(3)
+            self.turn_rate = numpy.zeros(3)
+        elif self.pos is not None and when > self.when:
+            elapsed = when - self.when
+            velocity = (pos - self.pos) / elapsed
+            turn_rate = (heading - self.heading) / elapsed
+            self.velocity += self.smoothing * (velocity - self.velocity)
+            self.turn_rate += self.smoothing * (turn_rate - self.turn_rate)
+
+        self.pos = pos
+        self.heading = heading
+        self.when = when
+
+    def predicted_views(self, seconds=PREDICT_SECONDS, steps=PREDICT_STEPS):
+        """Returns (pos, heading) of the camera at steps evenly spaced
+        times over the next seconds"""
+        if self.pos is None:
+            return []
+        views = []
+        for step in range(1, steps + 1):
+            t = seconds * step / float(steps)
+            views.append((self.pos + self.velocity * t, _normalize(self.heading + self.turn_rate * t)))
+        return views
+
+def in_view(pos, heading, half_fov, locs, radii):
+    """Returns a boolean array of which spheres, given as an Nx3 array of
+    locations and an array of radii, are at least partly inside the cone of
+    half angle half_fov radians around heading from pos"""
+    to_center = locs - pos
+    distance = numpy.sqrt((to_center * to_center).sum(axis=1))
+    inside = distance <= radii
+    safe_distance = numpy.where(inside, 1.0, distance)
+    cos_angle = numpy.clip((to_center * heading).sum(axis=1) / safe_distance, -1.0, 1.0)
+    angular_radius = numpy.arcsin(numpy.clip(radii / safe_distance, 0.0, 1.0))
+    return inside | (numpy.arccos(cos_angle) <= half_fov + angular_radius)
+
+def view_weights(predictor, half_fov, locs, radii):
+    """Returns the solid angle weight of each model for the camera's
+    current and predicted views"""
+    if predictor.pos is None:
+        return numpy.ones(len(radii))
+    visible = in_view(predictor.pos, predictor.heading, half_fov, locs, radii)
+    predicted = numpy.zeros(len(radii), dtype=bool)
+    for pos, heading in predictor.predicted_views():
+        predicted |= in_view(pos, heading, half_fov, locs, radii)
+    return numpy.where(visible, VISIBLE_WEIGHT, numpy.where(predicted, PREDICTED_WEIGHT, HIDDEN_WEIGHT))
+
+def half_fov_radians(fov):
+    """Returns the half angle of the cone around a lens with the given
+    (horizontal, vertical) field of view in degrees"""
+    # the cone through the corners of the frustum contains all of it
+    h = math.tan(math.radians(fov[0]) / 2.0)
+    v = math.tan(math.radians(fov[1]) / 2.0)
+    return math.atan(math.sqrt(h * h + v * v))
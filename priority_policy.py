@@ -0,0 +1,173 @@
+"""Priority policies for load tasks.
+
+A PriorityPolicy scores every kind of task from its model's state and the
+bytes it fetches. The active policy is a process-wide setting, picked with
+set_policy() before any task pool is created so that forked workers share
+it.
+
+Every priority has to be proportional to the solid angle of the task's
+model, since load_scheduler.rescale_priority rescales waiting tasks by the
+change in solid angle when the camera moves."""
+
+import math
+
+import open3dhub
+
+class PriorityPolicy(object):
+    """Base class for priority policies. Higher priorities run first."""
+
+    def model_priority(self, model):
+        """Returns the priority of a ModelDownloadTask"""
+        raise NotImplementedError()
+
+    def load_priority(self, model):
+        """Returns the priority of a LoadTask"""
+        return model.solid_angle
+
+    def texture_priority(self, model, tar_hash, mipmap_levels, level, base_pixels, shown_pixels):
+        """Returns the priority of a TextureDownloadTask for the given level
+        of mipmap_levels. base_pixels is the size of the level downloaded
+        with the model, and shown_pixels the size of the level shown when
+        this one arrives, which may be several levels below it."""
+        raise NotImplementedError()
+
+    def progressive_priority(self, model, progressive_hash, offset, length):
+        """Returns the priority of a ProgressiveDownloadTask for the given
+        range of the progressive stream"""
+        raise NotImplementedError()
+
+class DefaultPolicy(PriorityPolicy):
+    """The original heuristic. Everything is normalized by download size,
+    and whole models are boosted far above textures and refinements."""
+
+    MODEL_BOOST = 1 * 1000 * 1000 * 1000 * 1000
+
+    def model_priority(self, model):
+        # we want to normalize by file size
+        priority = model.solid_angle / float(open3dhub.model_download_size(model))
+        # but then also boost by a lot so that progressive download tasks don't overtake
+        return priority * self.MODEL_BOOST
+
+    def texture_priority(self, model, tar_hash, mipmap_levels, level, base_pixels, shown_pixels):
+        mipmap = mipmap_levels[level]
+        mipmap_pixels = mipmap['width'] * mipmap['height']
+        sizes = open3dhub.HASH_SIZES[tar_hash]
+
+        # priority is the solid angle
+        priority = model.solid_angle
+        # multiplied by a factor to make smaller textures higher priority over larger
+        priority = priority * math.sqrt(float(base_pixels) / mipmap_pixels)
+        # multiplied by how big this tar range is relative to the total size
+        priority = priority * (float(mipmap['length']) / sizes['size'])
+        # divided by the gzip size
+        return priority / sizes['gzip_size']
+
+    def progressive_priority(self, model, progressive_hash, offset, length):
+        sizes = open3dhub.HASH_SIZES[progressive_hash]
+
+        # priority is the solid angle
+        priority = model.solid_angle
+        # multiplied by a scale factor that makes earlier chunks have more weight.
+        # Chunks are weighed by where they start, since the last one ends
+        # exactly at the end of the stream and would weigh nothing.
+        percentage = float(offset) / sizes['size']
+        priority = priority * ((1.0 - percentage) ** 2)
+        # divided by the gzip size
+        return priority / sizes['gzip_size']
+
+class BenefitPerBytePolicy(PriorityPolicy):
+    """Scores each task by the visual benefit it brings per byte it costs.
+
+    Showing a model at all is worth its solid angle. A texture level is
+    worth a fraction of that for the share of pixels it adds, and a chunk
+    of the progressive stream for its share of the stream, less what the
+    chunks before it already brought."""
+
+    TEXTURE_BENEFIT = 0.5
+    """Benefit of a model's full resolution textures relative to showing it"""
+    PROGRESSIVE_BENEFIT = 0.5
+    """Benefit of a model's full progressive stream relative to showing it"""
+
+    def model_priority(self, model):
+        return model.solid_angle / float(open3dhub.model_download_size(model))
+
+    def load_priority(self, model):
+        # loading is CPU bound and unlocks everything after it, so shown
+        # models come first in order of size on screen
+        return model.solid_angle
+
+    def texture_priority(self, model, tar_hash, mipmap_levels, level, base_pixels, shown_pixels):
+        mipmap = mipmap_levels[level]
+        mipmap_pixels = mipmap['width'] * mipmap['height']
+        full_pixels = mipmap_levels[-1]['width'] * mipmap_levels[-1]['height']
+        shown_pixels = max(shown_pixels, base_pixels)
+
+        gain = float(max(0, mipmap_pixels - shown_pixels)) / max(1, full_pixels)
+        benefit = model.solid_angle * self.TEXTURE_BENEFIT * gain
+        return benefit / max(1, mipmap['length'])
+
+    def progressive_priority(self, model, progressive_hash, offset, length):
+        sizes = open3dhub.HASH_SIZES[progressive_hash]
+        start = min(1.0, float(offset) / sizes['size'])
+        end = min(1.0, float(offset + length) / sizes['size'])
+        # refinements at the start of the stream fix the largest errors, so
+        # a fraction of the stream is worth more the earlier it comes
+        gain = (1.0 - start) ** 2 - (1.0 - end) ** 2
+        benefit = model.solid_angle * self.PROGRESSIVE_BENEFIT * gain
+        chunk_bytes = max(1.0, (end - start) * sizes['gzip_size'])
+        return benefit / chunk_bytes
+
+class DeadlineFirstPolicy(PriorityPolicy):
+    """Gives every stage of a model a deadline by which it should be shown
+    and scores each task by its model's solid angle over that deadline.
+
+    A model's own download comes before its refinements, and each texture
+    level and progressive chunk gets a later deadline than the one before
+    it. Across models the solid angle counts too, so refinements of a model
+    much larger on screen can come before a small model is shown."""
+
+    MODEL_DEADLINE = 1.0
+    """Seconds by which every model should be shown"""
+    TEXTURE_LEVEL_DEADLINE = 4.0
+    """Seconds after that each further texture level is due"""
+    PROGRESSIVE_STREAM_DEADLINE = 32.0
+    """Seconds after that the whole progressive stream is due. A chunk is
+    due in proportion to how far into the stream it ends, so deadlines rise
+    with every chunk whatever their sizes."""
+
+    def model_priority(self, model):
+        return model.solid_angle / self.MODEL_DEADLINE
+
+    def load_priority(self, model):
+        return model.solid_angle / self.MODEL_DEADLINE
+
+    def texture_priority(self, model, tar_hash, mipmap_levels, level, base_pixels, shown_pixels):
+        levels_above_base = len([m for m in mipmap_levels[:level + 1]
+                                 if m['width'] * m['height'] > base_pixels])
+        deadline = self.MODEL_DEADLINE + self.TEXTURE_LEVEL_DEADLINE * levels_above_base
+        return model.solid_angle / deadline
+
+    def progressive_priority(self, model, progressive_hash, offset, length):
+        size = open3dhub.HASH_SIZES[progressive_hash]['size']
+        end = min(1.0, float(offset + length) / max(1, size))
+        deadline = self.MODEL_DEADLINE + self.PROGRESSIVE_STREAM_DEADLINE * end
+        return model.solid_angle / deadline
+
+POLICIES = {'default': DefaultPolicy,
+            'benefit-per-byte': BenefitPerBytePolicy,
+            'deadline-first': DeadlineFirstPolicy}
+"""Policies by the name they are chosen by on the command line"""
+
+_POLICY = DefaultPolicy()
+
+def get_policy():
+    """Returns the active priority policy"""
+    return _POLICY
+
+def set_policy(policy):
+    """Sets the active priority policy, given as a PriorityPolicy or the
+    name of one in POLICIES"""
+    global _POLICY
+    if isinstance(policy, basestring):
+        policy = POLICIES[policy]()
+    _POLICY = policy
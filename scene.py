@@ -1,6 +1,9 @@
 import open3dhub
 import cPickle
 import os
+import math
+
+import numpy
 
 CURDIR = os.path.dirname(__file__)
 
@@ -152,9 +155,10 @@ def get_demo_models(force=False):
     return demo_models
 
 def get_progressive_models(force=False):
-    """Returns all models that have a progressive format."""
+    """Returns all models that have a progressive format. Uses the persisted
+    catalog, refreshed incrementally unless force is set to True"""
     
-    all_cdn_models = open3dhub.get_list(100000)
+    all_cdn_models = open3dhub.refresh_catalog(force)
     progressive_models = filter_non_progressive(all_cdn_models)
     progressive_models = filter_bad_list(progressive_models)
     #progressive_models = filter_non_panda3d(progressive_models)
@@ -176,3 +180,23 @@ def get_all_models(force=False):
     cPickle.dump(all_cdn_models, open(all_model_file, 'w'), protocol=cPickle.HIGHEST_PROTOCOL)
     
     return all_cdn_models
+
+MAX_SOLID_ANGLE = 4.0 * math.pi
+def solid_angles(cameraLoc, objLocs, objRadii):
+    """Calculates the solid angles between the camera and an array of
+    objects, given as an Nx3 array of locations and an array of radii"""
+    
+    to_center_len = numpy.sqrt(((objLocs - cameraLoc) ** 2).sum(axis=1))
+    inside = to_center_len <= objRadii
+    
+    sin_alpha = objRadii / numpy.where(inside, 1.0, to_center_len)
+    cos_alpha = numpy.sqrt(numpy.clip(1.0 - sin_alpha * sin_alpha, 0.0, 1.0))
+    return numpy.where(inside, MAX_SOLID_ANGLE, 2.0 * math.pi * (1.0 - cos_alpha))
+
+def model_bounds(models):
+    """Returns the locations of models as an Nx3 array and their bounding
+    radii as an array, for solid_angles"""
+    
+    locs = numpy.array([(m.x, m.y, m.z) for m in models], dtype=numpy.float64).reshape(-1, 3)
+    radii = numpy.array([m.scale * 1000 for m in models], dtype=numpy.float64)
+    return locs, radii
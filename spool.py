@@ -0,0 +1,93 @@
+"""Hand-off of downloaded payloads between processes through spool files.
+
+A download worker writes its payloads once into a spool file and passes
+around Payload handles, which pickle as just a path, offset and length.
+The loader maps the file instead of receiving the bytes through a pipe."""
+
+import os
+import mmap
+import errno
+import tempfile
+from cStringIO import StringIO
+
+CURDIR = os.path.dirname(__file__)
+TEMPDIR = os.path.join(CURDIR, '.temp_models')
+SPOOL_DIR = os.path.join(TEMPDIR, 'spool')
+
+class Payload(object):
+    """A handle to a range of bytes in a spool file"""
+
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def view(self):
+        """Returns a zero-copy, read-only buffer over the payload"""
+        if self.length == 0:
+            return buffer('')
+        f = open(self.path, 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return buffer(m, self.offset, self.length)
+
+    def open(self):
+        """Returns a read-only file object over the payload"""
+        return StringIO(self.view())
+
+    def read(self):
+        """Returns the payload as a string"""
+        return str(self.view())
+
+    def release(self):
+        """Removes the spool file holding this payload"""
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return "<Payload '%s' offset=%d length=%d>" % (self.path, self.offset, self.length)
+    def __repr__(self):
+        return str(self)
+
+def write_payloads(datas):
+    """Writes a list of strings or buffers into a new spool file and returns
+    a Payload for each of them"""
+    try:
+        os.makedirs(SPOOL_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix='.spool')
+    f = os.fdopen(fd, 'wb')
+    payloads = []
+    offset = 0
+    try:
+        for data in datas:
+            f.write(data)
+            payloads.append(Payload(path, offset, len(data)))
+            offset += len(data)
+    finally:
+        f.close()
+
+    return payloads
+
+def read(data):
+    """Returns data as a string whether it is a Payload or already a string"""
+    if isinstance(data, Payload):
+        return data.read()
+    return data
+
+def open_data(data):
+    """Returns a file object over data, which is a Payload or a string"""
+    if isinstance(data, Payload):
+        return data.open()
+    return StringIO(data)
@@ -70,7 +70,7 @@ def getModel(index_num):
             else:
                 #print 'calling download subtask for model', model.model_json['full_path']
                 load_task = open3dhub.download_mesh_and_subtasks(model)[0]
-                yield open3dhub.load_into_bamfile(load_task.meshdata, load_task.subfiles, load_task.model)
+                yield load_scheduler.execute_load(load_task.meshdata, load_task.subfiles, load_task.model, load_task.prog_data)
 
 outContents = []
 model_iter = None #iter(getModels())
@@ -0,0 +1,205 @@
+"""Task lifecycle tracing for the load pipeline.
+
+Tracing is off by default, and every hook then returns after checking one
+module global. Once enabled, TaskPool records when each task is queued,
+started and finished, on which worker, with how many bytes downloaded and
+at what priority, and which task it is a dependent of. Code running in a
+task or on the main thread marks its stages with span().
+
+write() exports everything in the Chrome trace event format, which opens
+in chrome://tracing and Perfetto, and summary() tabulates latency
+percentiles per stage.
+
+Enable tracing before creating any TaskPool, so that forked pool workers
+inherit it."""
+
+import os
+import time
+import json
+import itertools
+import threading
+from collections import namedtuple
+
+ENABLED = False
+"""Whether events are being recorded"""
+
+RunInfo = namedtuple('RunInfo', ['bytes', 'worker', 'started', 'finished', 'spans'])
+"""How a task ran in its worker, returned with the task's result"""
+
+_T0 = time.time()
+_lock = threading.Lock()
+_events = []
+_durations = {}
+_ids = itertools.count(1)
+_local = threading.local()
+
+def enable():
+    """Starts recording events"""
+    global ENABLED
+    ENABLED = True
+
+def _us(t):
+    return int((t - _T0) * 1000000)
+
+def worker_name():
+    """Returns a name for the calling worker thread, unique across processes"""
+    return '%d/%s' % (os.getpid(), threading.current_thread().name)
+
+def _add_duration(stage, seconds):
+    _durations.setdefault(stage, []).append(seconds)
+
+def _add_event(name, cat, track, tid, start, end, args=None):
+    event = {'name': name, 'cat': cat, 'ph': 'X',
+             'pid': track, 'tid': tid,
+             'ts': _us(start), 'dur': max(0, _us(end) - _us(start))}
+    if args:
+        event['args'] = args
+    _events.append(event)
+
+def _task_id(task):
+    if task.trace_id is None:
+        task.trace_id = next(_ids)
+    return task.trace_id
+
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            # inside a pool worker, the spans go back with the task's result
+            spans.append((self.name, self.start, end))
+        else:
+            with _lock:
+                _add_event(self.name, 'stage', 'main', threading.current_thread().name, self.start, end)
+                _add_duration(self.name, end - self.start)
+        return False
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name):
+    """Returns a context manager that records the enclosed code as a stage
+    called name"""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+def begin_collect():
+    """Starts collecting the calling worker thread's spans for a task"""
+    if ENABLED:
+        _local.spans = []
+
+def end_collect():
+    """Returns the spans collected since begin_collect()"""
+    spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    return spans or []
+
+def task_enqueued(task):
+    if not ENABLED:
+        return
+    _task_id(task)
+    task.trace_enqueued = time.time()
+
+def task_dispatched(task):
+    if not ENABLED:
+        return
+    task.trace_priority = task.priority
+
+def set_parent(tasks, parent):
+    """Records parent as the task that created each of tasks"""
+    if not ENABLED:
+        return
+    parent_id = _task_id(parent)
+    for task in tasks:
+        task.trace_parent = parent_id
+
+def task_finished(task, pool_name, status, info):
+    """Records a task that came back from pool_name's workers with the
+    given status and RunInfo"""
+    if not ENABLED:
+        return
+
+    stage = type(task).__name__
+    task_id = _task_id(task)
+    args = {'id': task_id,
+            'parent': task.trace_parent,
+            'priority': task.trace_priority,
+            'bytes': info.bytes,
+            'status': status}
+    model = getattr(task, 'model', None)
+    if model is not None:
+        args['model'] = model.model_json.get('full_path')
+
+    with _lock:
+        if task.trace_enqueued is not None:
+            _add_event(stage, 'queue', pool_name, 'queue', task.trace_enqueued, task.started, {'id': task_id})
+            _add_duration(stage + ' queued', task.started - task.trace_enqueued)
+        _add_event(stage, 'run', pool_name, info.worker, info.started, info.finished, args)
+        _add_duration(stage + ' run', info.finished - info.started)
+        for name, start, end in info.spans:
+            _add_event(name, 'stage', pool_name, info.worker, start, end, {'id': task_id})
+            _add_duration(name, end - start)
+
+def _percentile(ordered, fraction):
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summary():
+    """Returns a table of latency percentiles, in milliseconds, per stage"""
+    with _lock:
+        durations = dict((stage, sorted(values)) for stage, values in _durations.iteritems())
+
+    width = max([len('stage')] + [len(stage) for stage in durations])
+    lines = ['%-*s %7s %9s %9s %9s %9s' % (width, 'stage', 'count', 'p50', 'p90', 'p99', 'max')]
+    for stage in sorted(durations):
+        values = durations[stage]
+        lines.append('%-*s %7d %9.1f %9.1f %9.1f %9.1f' % (width, stage, len(values),
+                                                          _percentile(values, 0.5) * 1000,
+                                                          _percentile(values, 0.9) * 1000,
+                                                          _percentile(values, 0.99) * 1000,
+                                                          values[-1] * 1000))
+    return '\n'.join(lines)
+
+def write(path):
+    """Writes the recorded events to path as a Chrome trace"""
+    with _lock:
+        events = [dict(event) for event in _events]
+
+    # the trace format wants numeric process and thread ids, with names
+    # given by metadata events
+    pids = {}
+    tids = {}
+    metadata = []
+    for event in events:
+        track = event['pid']
+        if track not in pids:
+            pids[track] = len(pids) + 1
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': pids[track],
+                             'args': {'name': track}})
+        key = (track, event['tid'])
+        if key not in tids:
+            tids[key] = len(tids) + 1
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[track], 'tid': tids[key],
+                             'args': {'name': str(event['tid'])}})
+        event['pid'] = pids[track]
+        event['tid'] = tids[key]
+
+    f = open(path, 'w')
+    try:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    finally:
+        f.close()